@@ -20,10 +20,13 @@ import tsdate
 import daiquiri
 import numpy as np
 import pandas as pd
-import tqdm
 import humanize
 import cyvcf2
 
+# Shared helpers live in src/utility.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import utility  # NOQA
+
 
 
 def run_simplify(args):
@@ -157,14 +160,10 @@ def get_augmented_samples(tables):
     # augmented here because they might have been simplified out.
     # return np.load("ukbb_chr20.augmented_samples.npy")
     nodes = tables.nodes
-    ids = np.where(nodes.flags == tsinfer.NODE_IS_SAMPLE_ANCESTOR)[0]
-    sample_ids = np.zeros(len(ids), dtype=int)
-    for j, node_id in enumerate(tqdm.tqdm(ids)):
-        offset = nodes.metadata_offset[node_id : node_id + 2]
-        buff = bytearray(nodes.metadata[offset[0] : offset[1]])
-        md = json.loads(buff.decode())
-        sample_ids[j] = md["sample"]
-    return sample_ids
+    is_augmented = nodes.flags == tsinfer.NODE_IS_SAMPLE_ANCESTOR
+    return utility.decode_metadata_field(
+        nodes.metadata, nodes.metadata_offset, "sample", is_augmented
+    ).astype(int)
 
 
 def run_compute_ukbb_gnn(args):
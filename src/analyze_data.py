@@ -4,8 +4,8 @@ plotting in plot.py
 """
 import argparse
 import os.path
-import json
 import collections
+import multiprocessing
 
 import numpy as np
 import pandas as pd
@@ -14,7 +14,6 @@ import sys
 
 import tskit
 import tsinfer
-import tqdm
 
 import argparse
 import pandas as pd
@@ -26,67 +25,89 @@ from os import path
 import tsinfer
 import tskit
 import sys
-from tqdm import tqdm
 
 import tsdate
 
+import utility
+
 data_prefix = "all-data"
 
-def get_relate_tgp_age_df():
-#    if path.exists("all-data/1kg_chr20_relate_mutation_ages_geometric.csv"):
-#        relate_ages = pd.read_csv("all-data/1kg_chr20_relate_mutation_ages_geometric.csv", index_col=0)
-#    else:
-    relate_ts = tskit.load("/home/jk/large_files/relate/relate_chr20_metdata.trees")
-    relate_mut_ages, relate_mut_upper_bound, mut_ids = get_mut_ages(relate_ts,
-            unconstrained=False, geometric=False)
-    relate_frequencies = get_site_frequencies(relate_ts)
-    relate_ages = pd.DataFrame(
-        {
-            "position": relate_ts.tables.sites.position[
-                relate_ts.tables.mutations.site
-            ][mut_ids],
-            "relate_age": relate_mut_ages,
-            "relate_upper_bound": relate_mut_upper_bound,
-            "relate_ancestral_allele": np.array(tskit.unpack_strings(relate_ts.tables.sites.ancestral_state,
-                relate_ts.tables.sites.ancestral_state_offset))[relate_ts.tables.mutations.site][mut_ids],
-            "relate_derived_allele": np.array(tskit.unpack_strings(relate_ts.tables.mutations.derived_state,
-                relate_ts.tables.mutations.derived_state_offset))[mut_ids],
-            "relate_frequency": relate_frequencies
-        }
-    )
-    relate_ages.to_csv("all-data/1kg_chr20_relate_mutation_ages_geometric.csv")
-    return relate_ages
+relate_tgp_fn = "/home/jk/large_files/relate/relate_chr20_metdata.trees"
+geva_atlas_fn = "/home/wilderwohns/tsinfer_geva/atlas.chr20.csv.gz"
+tsdate_tgp_fn = os.path.join(
+    data_prefix,
+    "1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16.simplified.dated.insideoutside.trees")
 
-def get_geva_tgp_age_df():
-    if path.exists("all-data/1kg_chr20_geva_mutation_ages.csv"):
-        geva_ages = pd.read_csv("all-data/1kg_chr20_geva_mutation_ages.csv", index_col=0)
-    else:
-        geva = pd.read_csv(
-            "/home/wilderwohns/tsinfer_geva/atlas.chr20.csv.gz",
-            delimiter=",",
-            skipinitialspace=True,
-            skiprows=3,
-        )
-        geva_tgp = geva[geva["DataSource"] == "TGP"]
-        geva_tgp_consistent = geva_tgp[geva_tgp["AlleleAnc"] == geva_tgp["AlleleRef"]]
-        geva_ages = geva_tgp_consistent[["Position", "AgeMean_Jnt", "AgeCI95Upper_Jnt", "AlleleRef", "AlleleAlt"]]
-        geva_ages.to_csv("all-data/1kg_chr20_geva_mutation_ages.csv")
-    return geva_ages
 
-def get_tsdate_tgp_age_df():
-    if path.exists("all-data/tsdate_ages_1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16.simplified.dated.insideoutside.trees"):
-        tsdate_ages = pd.read_csv("all-data/tsdate_ages_1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16.simplified.dated.insideoutside.trees", index_col=0)
+def get_relate_tgp_age_df():
+    def compute():
+        relate_ts = tskit.load(relate_tgp_fn)
+        relate_mut_ages, relate_mut_upper_bound, mut_ids = get_mut_ages(relate_ts,
+                unconstrained=False, geometric=False)
+        relate_frequencies = get_site_frequencies(relate_ts)
+        return pd.DataFrame(
+            {
+                "position": relate_ts.tables.sites.position[
+                    relate_ts.tables.mutations.site
+                ][mut_ids],
+                "relate_age": relate_mut_ages,
+                "relate_upper_bound": relate_mut_upper_bound,
+                "relate_ancestral_allele": np.array(tskit.unpack_strings(relate_ts.tables.sites.ancestral_state,
+                    relate_ts.tables.sites.ancestral_state_offset))[relate_ts.tables.mutations.site][mut_ids],
+                "relate_derived_allele": np.array(tskit.unpack_strings(relate_ts.tables.mutations.derived_state,
+                    relate_ts.tables.mutations.derived_state_offset))[mut_ids],
+                "relate_frequency": relate_frequencies
+            }
+        )
+    return utility.artifact_cache.get_dataframe(
+        "relate_tgp_ages", compute, inputs=[relate_tgp_fn],
+        params={"unconstrained": False, "geometric": False})
 
-    else:
+def read_geva_atlas(filename, chromosome=None, data_source="TGP", chunksize=1000000):
+    """
+    Stream a (gzipped) GEVA atlas CSV, keeping rows from data_source whose ancestral
+    allele is the reference allele, optionally only on one chromosome. Only the
+    columns we use are parsed, so genome-wide atlases never sit in memory whole.
+    """
+    columns = ["Chromosome", "Position", "AlleleRef", "AlleleAlt", "AlleleAnc",
+            "DataSource", "AgeMean_Jnt", "AgeCI95Upper_Jnt"]
+    dtypes = {"Chromosome": str, "Position": np.int32, "AlleleRef": str,
+            "AlleleAlt": str, "AlleleAnc": str, "DataSource": str,
+            "AgeMean_Jnt": np.float64, "AgeCI95Upper_Jnt": np.float64}
+    reader = pd.read_csv(
+        filename,
+        delimiter=",",
+        skipinitialspace=True,
+        skiprows=3,
+        usecols=columns,
+        dtype=dtypes,
+        chunksize=chunksize,
+    )
+    kept = []
+    for chunk in reader:
+        keep = np.logical_and(
+            chunk["DataSource"].to_numpy() == data_source,
+            chunk["AlleleAnc"].to_numpy() == chunk["AlleleRef"].to_numpy())
+        if chromosome is not None:
+            keep = np.logical_and(keep, chunk["Chromosome"].to_numpy() == str(chromosome))
+        kept.append(chunk.loc[keep, ["Position", "AgeMean_Jnt", "AgeCI95Upper_Jnt",
+            "AlleleRef", "AlleleAlt"]])
+    return pd.concat(kept, ignore_index=True)
+
+def get_geva_tgp_age_df(chromosome=20):
+    return utility.artifact_cache.get_dataframe(
+        "geva_tgp_ages_chr{}".format(chromosome),
+        lambda: read_geva_atlas(geva_atlas_fn, chromosome=chromosome),
+        inputs=[geva_atlas_fn], params={"DataSource": "TGP"})
 
-        tgp_chr20 = tskit.load(
-                "all-data/1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16.simplified.dated.insideoutside.trees")
-        
+def get_tsdate_tgp_age_df():
+    def compute():
+        tgp_chr20 = tskit.load(tsdate_tgp_fn)
         posterior_mut_ages, posterior_upper_bound, oldest_mut_nodes = get_mut_ages(
             tgp_chr20, unconstrained=False
         )
         site_frequencies = get_site_frequencies(tgp_chr20)
-        tsdate_ages = pd.DataFrame(
+        return pd.DataFrame(
             {
                 "position": tgp_chr20.tables.sites.position,
                 "tsdate_age": posterior_mut_ages,
@@ -98,73 +119,99 @@ def get_tsdate_tgp_age_df():
                     tgp_chr20.tables.mutations.derived_state_offset))[oldest_mut_nodes]
             }
         )
-        tsdate_ages.to_csv(
-                "all-data/tsdate_ages_1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16.simplified.dated.insideoutside.trees")
-    return tsdate_ages
+    return utility.artifact_cache.get_dataframe(
+        "tsdate_tgp_ages", compute, inputs=[tsdate_tgp_fn],
+        params={"unconstrained": False})
 
 
-def tgp_date_estimates():
+def tgp_date_estimates(chunksize=1000000):
     """
     Produce comparable set of mutations from tgp
+    Tables are joined on int64 keys packing position, ancestral and derived allele,
+    merging sorted chunks so the output is written incrementally. The three input
+    tables are still loaded and sorted in full; only the join and output are chunked.
     """
     tsdate_ages = get_tsdate_tgp_age_df()
+    tsdate_ages["key"] = utility.encode_allele_keys(
+        tsdate_ages["position"], tsdate_ages["tsdate_ancestral_allele"],
+        tsdate_ages["tsdate_derived_allele"])
     geva = get_geva_tgp_age_df()
-    merged = pd.merge(tsdate_ages,
-            geva, 
-            left_on=["position", "tsdate_ancestral_allele", "tsdate_derived_allele"],
-            right_on=["Position", "AlleleRef", "AlleleAlt"])
+    geva["key"] = utility.encode_allele_keys(
+        geva["Position"], geva["AlleleRef"], geva["AlleleAlt"])
     relate_ages = get_relate_tgp_age_df()
-    merged = pd.merge(merged, relate_ages,
-            left_on=["Position", "tsdate_ancestral_allele", "tsdate_derived_allele"],
-            right_on=["position", "relate_ancestral_allele", "relate_derived_allele"])
-    merged = merged[np.abs(merged["tsdate_frequency"] - merged["relate_frequency"]) < 0.5]
-    merged = merged.drop(columns=["position_x", "position_y"])
-    merged.to_csv("all-data/tgp_mutations.csv")
-
-def get_site_frequencies(ts):
+    relate_ages["key"] = utility.encode_allele_keys(
+        relate_ages["position"], relate_ages["relate_ancestral_allele"],
+        relate_ages["relate_derived_allele"])
+    merged = utility.sorted_merge_join(
+        utility.iter_sorted_chunks(tsdate_ages, "key", chunksize),
+        utility.iter_sorted_chunks(geva, "key", chunksize),
+        right_columns=geva.columns)
+    merged = utility.sorted_merge_join(
+        merged, utility.iter_sorted_chunks(relate_ages, "key", chunksize),
+        right_columns=relate_ages.columns)
+    output_fn = "all-data/tgp_mutations.csv"
+    num_rows = 0
+    for chunk in merged:
+        first = num_rows == 0
+        chunk.index = np.arange(num_rows, num_rows + len(chunk))
+        num_rows += len(chunk)
+        chunk = chunk[np.abs(chunk["tsdate_frequency"] - chunk["relate_frequency"]) < 0.5]
+        chunk = chunk.drop(columns=["position_x", "position_y", "key"])
+        chunk.to_csv(output_fn, mode="w" if first else "a", header=first)
+
+def get_site_frequencies(ts, by_population=False):
     """
-    Calculate frequency of each site and return numpy 1d array of len num_mutations 
+    Calculate frequency of each site and return numpy 1d array of len num_sites
     with frequency as values. This assumes that if there are multiple mutations at a 
-    site they are recurrent.
+    site they are recurrent. Counts are the number of samples below the mutations at
+    each site, taken from tskit's site-mode sample count statistic, so no genotypes
+    are decoded. If by_population is True, also return a (num_sites, num_populations)
+    array of frequencies within each population, computed in the same pass
+    (NaN for populations without samples).
     """
-    site_freq = np.zeros(ts.num_sites)
-    for var in tqdm(ts.variants(), total=ts.num_sites, desc="Get mutation frequencies"):
-        site_freq[var.site.id] = np.sum(var.genotypes) / ts.num_samples
-    return site_freq 
+    samples = ts.samples()
+    sample_pops = ts.tables.nodes.population[samples]
+    pop_ids = []
+    if by_population:
+        pop_ids = np.unique(sample_pops[sample_pops != tskit.NULL])
+    sample_sets = [samples] + [samples[sample_pops == pop] for pop in pop_ids]
+    site_freq = np.zeros((ts.num_sites, len(sample_sets)))
+    if ts.num_sites > 0:
+        # One window per site: the first window starts at 0 and the last ends at L
+        positions = ts.tables.sites.position
+        windows = np.concatenate(([0], positions[1:], [ts.sequence_length]))
+        counts = ts.sample_count_stat(
+            sample_sets, lambda x: x, len(sample_sets), windows=windows,
+            polarised=True, span_normalise=False, strict=False)
+        site_freq = counts / np.array([len(sample_set) for sample_set in sample_sets])
+    if not by_population:
+        return site_freq[:, 0]
+    pop_freq = np.full((ts.num_sites, ts.num_populations), np.nan)
+    pop_freq[:, pop_ids] = site_freq[:, 1:]
+    return site_freq[:, 0], pop_freq
 
 def get_mut_ages(ts, unconstrained=True, ignore_sample_muts=False, geometric=True):
-    mut_ages = np.zeros(ts.num_sites)
-    mut_upper_bounds = np.zeros(ts.num_sites)
-    node_ages = ts.tables.nodes.time
-    oldest_mut_ids = np.zeros(ts.num_sites)
     if unconstrained:
-        metadata = ts.tables.nodes.metadata[:]
-        metadata_offset = ts.tables.nodes.metadata_offset[:]
-        for index, met in enumerate(tskit.unpack_bytes(metadata, metadata_offset)):
-            if index not in ts.samples():
-                node_ages[index] = json.loads(met.decode())["mn"]
+        node_ages = utility.get_unconstrained_node_times(ts)
+    else:
+        node_ages = ts.tables.nodes.time
     if ignore_sample_muts:
         mutations_table = ts.tables.mutations
         unique_sites = np.unique(ts.tables.mutations.site, return_counts=True)
         unique_sites = unique_sites[0][unique_sites[1] > 1]
         no_samp_muts = ~np.logical_and(np.isin(mutations_table.site, unique_sites),
                 np.isin(mutations_table.node, ts.samples()))
-    for tree in tqdm(ts.trees(), total=ts.num_trees, desc="Finding mutation ages"):
-        for site in tree.sites():
-            for mut in site.mutations:
-                parent_age = node_ages[tree.parent(mut.node)]
-                if geometric:
-                    age = np.sqrt(node_ages[mut.node] * parent_age)
-                else:
-                    age = (node_ages[mut.node] + parent_age) / 2
-                if mut_ages[site.id] < age:
-                    mut_upper_bounds[site.id] = parent_age
-                    mut_ages[site.id] = age
-                    oldest_mut_ids[site.id] = mut.id
+    mut_ages, mut_upper_bounds, oldest_mut_ids = utility.get_site_ages(
+            ts, node_ages, geometric=geometric)
+    # Sites without mutations are reported with an age and upper bound of zero
+    no_muts = oldest_mut_ids == -1
+    mut_ages[no_muts] = 0
+    mut_upper_bounds[no_muts] = 0
+    oldest_mut_ids[no_muts] = 0
     return mut_ages, mut_upper_bounds, oldest_mut_ids.astype(int)
 
 
-def get_ancient_constraints_tgp():
+def load_ancient_constraints_tgp():
     if path.exists("all-data/1kg_ancients_only_chr20.samples"):
         ancient_samples = tsinfer.load("all-data/1kg_ancients_only_chr20.samples")
     else:
@@ -172,25 +219,40 @@ def get_ancient_constraints_tgp():
         print("Subsetting SampleData file to only keep ancient samples")
         ancient_indiv_ids = np.where(ancient_samples.individuals_time[:] != 0)[0]
         ancient_sample_ids = np.where(ancient_samples.individuals_time[:][ancient_samples.samples_individual] != 0)[0]
-        ancient_genos = ancient_samples.sites_genotypes[:]
-        ancient_sites = np.where(np.any(ancient_genos[:, ancient_sample_ids] == 1, axis=1))[0]
+        ancient_sites = np.concatenate([
+            start + np.where(np.any(genos == 1, axis=1))[0]
+            for start, genos in utility.genotype_chunks(ancient_samples, ancient_sample_ids)])
         ancient_samples = ancient_samples.subset(individuals=ancient_indiv_ids,
                 sites=ancient_sites)
         copy = ancient_samples.copy("all-data/1kg_ancients_only_chr20.samples")
         copy.finalise() 
         print("Subsetted to {} samples and {} sites".format(
             ancient_samples.num_samples, ancient_samples.num_sites))
-    genotypes = ancient_samples.sites_genotypes[:]
     positions = ancient_samples.sites_position[:]
     alleles = ancient_samples.sites_alleles[:]
-    min_site_times = ancient_samples.min_site_times(individuals_only=True)
-    lower_bound = [
-            (pos, allele[0], allele[1], age, np.sum(geno[geno==1]))
-            for pos, allele, age, geno in zip(positions, alleles, min_site_times, genotypes)
-    ]
-    constraint_df = pd.DataFrame(lower_bound, columns=["Position", "Reference Allele",
-        "Alternative Allele", "Ancient Bound", "Number of Ancients"])
-    constraint_df = constraint_df.astype({"Position": "int64", "Ancient Bound": "float64", "Number of Ancients": "int32"})
+    sample_times = ancient_samples.individuals_time[:][ancient_samples.samples_individual[:]]
+    # Oldest carrier of the derived allele and number of carriers, one chunk at a time
+    ancient_bound = np.zeros(ancient_samples.num_sites)
+    num_ancients = np.zeros(ancient_samples.num_sites, dtype=np.int32)
+    for start, genos in utility.genotype_chunks(ancient_samples):
+        stop = start + genos.shape[0]
+        ancient_bound[start:stop] = np.max(
+            np.where(genos > 0, sample_times, 0), axis=1, initial=0)
+        num_ancients[start:stop] = np.sum(genos == 1, axis=1)
+    constraint_df = pd.DataFrame({"Position": positions,
+        "Reference Allele": [allele[0] for allele in alleles],
+        "Alternative Allele": [allele[1] for allele in alleles],
+        "Ancient Bound": ancient_bound, "Number of Ancients": num_ancients})
+    return constraint_df.astype({"Position": "int64", "Ancient Bound": "float64", "Number of Ancients": "int32"})
+
+
+def get_ancient_constraints_tgp():
+    # Key the cache on the file load_ancient_constraints_tgp reads
+    source_fn = "all-data/1kg_ancients_only_chr20.samples"
+    if not path.exists(source_fn):
+        source_fn = "all-data/1kg_ancients_chr20.samples"
+    constraint_df = utility.artifact_cache.get_dataframe(
+        "ancient_constraints_tgp", load_ancient_constraints_tgp, inputs=[source_fn])
     constraint_df = constraint_df[constraint_df["Ancient Bound"] != 0]
     #constraint_df = constraint_df.set_index("Position")
     constraint_df.to_csv("all-data/ancient_constraints.csv")
@@ -199,44 +261,108 @@ def get_ancient_constraints_tgp():
         tgp_mut_ests = pd.read_csv("all-data/tgp_mutations.csv", index_col=0)
     except:
         raise ValueError("tgp_mutations.csv does not exist. Must run tgp_dates first")
-    tgp_muts_constraints = pd.merge(
-        tgp_mut_ests, constraint_df, how="left",
-        left_on=["Position", "tsdate_ancestral_allele", "tsdate_derived_allele"],
-        right_on=["Position", "Reference Allele", "Alternative Allele"])
+    tgp_mut_ests["key"] = utility.encode_allele_keys(
+        tgp_mut_ests["Position"], tgp_mut_ests["tsdate_ancestral_allele"],
+        tgp_mut_ests["tsdate_derived_allele"])
+    constraint_df = constraint_df.assign(key=utility.encode_allele_keys(
+        constraint_df["Position"], constraint_df["Reference Allele"],
+        constraint_df["Alternative Allele"])).drop(columns=["Position"])
+    # Both tables are held in memory; only the join itself works in chunks
+    tgp_muts_constraints = pd.concat(utility.sorted_merge_join(
+        utility.iter_sorted_chunks(tgp_mut_ests, "key"),
+        utility.iter_sorted_chunks(constraint_df, "key"), how="left",
+        right_columns=constraint_df.columns))
+    tgp_muts_constraints = tgp_muts_constraints.drop(columns=["key"])
+    tgp_muts_constraints.index = np.arange(len(tgp_muts_constraints))
     tgp_muts_constraints.to_csv("all-data/tgp_muts_constraints.csv")
 
-def get_recurrent_mutations(ts):
+def get_mutation_sample_counts(ts, left=0, right=None):
+    """
+    Return the ids of the mutations at sites in [left, right) and the number of
+    samples below each of them, from a single pass over the trees in that interval.
     """
-    Get number of mutations per site.
+    if right is None:
+        right = ts.sequence_length
+    tables = ts.tables
+    mut_nodes = tables.mutations.node
+    mut_pos = tables.sites.position[tables.mutations.site]
+    start, stop = np.searchsorted(mut_pos, [left, right])
+    num_samples = np.zeros(stop - start, dtype=np.int64)
+    if start == stop:
+        return np.arange(start, stop), num_samples
+    # Seek straight to the first tree in the interval rather than building every
+    # tree to its left
+    tree = tskit.Tree(ts)
+    tree.seek(left)
+    while True:
+        tree_left, tree_right = tree.interval
+        lo, hi = np.searchsorted(
+            mut_pos, [max(tree_left, left), min(tree_right, right)])
+        num_samples[lo - start: hi - start] = [
+            tree.num_samples(node) for node in mut_nodes[lo:hi]]
+        if tree_right >= right or not tree.next():
+            break
+    return np.arange(start, stop), num_samples
+
+
+def _init_recurrent_worker(ts):
+    global _recurrent_ts
+    _recurrent_ts = ts
+
+
+def _recurrent_worker(interval):
+    return get_mutation_sample_counts(_recurrent_ts, *interval)
+
+
+def count_histogram(values):
     """
-    mutations_sites = ts.tables.mutations.site
-    muts_per_site = np.unique(mutations_sites, return_counts=True)[1]
-    sites_by_muts = np.unique(muts_per_site, return_counts=True)[1]
+    Return the number of times each distinct value occurs, in increasing order of
+    value (equivalent to np.unique(values, return_counts=True)[1]).
+    """
+    counts = np.bincount(values)
+    return counts[counts > 0]
+
+
+def get_recurrent_mutations(ts, num_processes=1):
+    """
+    Get number of mutations per site. The number of samples below each mutation is
+    found in one streaming pass over the trees, optionally split into genomic chunks
+    with equal numbers of mutations across worker processes, and every histogram is
+    then computed with np.bincount over the mutation arrays.
+    """
+    tables = ts.tables
+    mut_sites = tables.mutations.site
+    mut_pos = tables.sites.position[mut_sites]
+    if num_processes > 1 and len(mut_pos) > 0:
+        breaks = mut_pos[np.linspace(0, len(mut_pos), num_processes + 1)[1:-1].astype(int)]
+        breaks = np.unique(np.concatenate(([0], breaks, [ts.sequence_length])))
+        num_samples = np.zeros(ts.num_mutations, dtype=np.int64)
+        with multiprocessing.Pool(
+                processes=num_processes, initializer=_init_recurrent_worker,
+                initargs=(ts,)) as pool:
+            for mut_ids, counts in pool.imap_unordered(
+                    _recurrent_worker, zip(breaks[:-1], breaks[1:])):
+                num_samples[mut_ids] = counts
+    else:
+        _, num_samples = get_mutation_sample_counts(ts)
+
+    muts_per_site = np.bincount(mut_sites, minlength=ts.num_sites)
+    sites_by_muts = count_histogram(muts_per_site[muts_per_site > 0])
 
     # Exclude mutations above samples, this is simplier as there are no singletons
-    mutations_sites = mutations_sites[~np.isin(ts.tables.mutations.node, ts.samples())]
-    muts_per_site = np.unique(mutations_sites, return_counts=True)[1]
-    sites_by_muts_nosamples = np.unique(muts_per_site, return_counts=True)[1]
+    is_sample = (tables.nodes.flags & tskit.NODE_IS_SAMPLE) != 0
+    non_sample_edge = ~is_sample[tables.mutations.node]
+    muts_per_site = np.bincount(mut_sites[non_sample_edge], minlength=ts.num_sites)
+    sites_by_muts_nosamples = count_histogram(muts_per_site[muts_per_site > 0])
+
     # Exclude mutations above two samples
-    muts_non_sample_edge = np.where(~np.isin(ts.tables.mutations.node, ts.samples()))[0]
-    muts_non_sample_edge_set = set(muts_non_sample_edge)
-    mut_sites_nodouble = list()
-    for tree in ts.trees():
-        for site in tree.sites():
-            for mutation in site.mutations:
-                if tree.num_samples(mutation.node) > 2:
-                    mut_sites_nodouble.append(mutation.site)
-    unique_sites_counts_nodouble = np.unique(np.array(mut_sites_nodouble), return_counts=True)[1]
-    sites_by_muts_nodouble = np.unique(unique_sites_counts_nodouble, return_counts=True)[1]
-
-    # Tips below mutations at sites with two mutations
-    two_mutations_id = set(muts_non_sample_edge[np.where(np.unique(mutations_sites, return_counts=True)[1] == 2)[0]])
-    num_samples_muts = list()
-    for tree in ts.trees():
-        for site in tree.sites():
-            for mutation in site.mutations:
-                if mutation.id in two_mutations_id:
-                    num_samples_muts.append(tree.num_samples(mutation.node))
+    nodouble_per_site = np.bincount(
+        mut_sites[num_samples > 2], minlength=ts.num_sites)
+    sites_by_muts_nodouble = count_histogram(nodouble_per_site[nodouble_per_site > 0])
+
+    # Tips below mutations (not above samples) at sites with two such mutations
+    two_mutations = np.logical_and(non_sample_edge, muts_per_site[mut_sites] == 2)
+    num_samples_muts = num_samples[two_mutations]
 
     return sites_by_muts, sites_by_muts_nosamples, sites_by_muts_nodouble, num_samples_muts
 
@@ -246,58 +372,61 @@ def get_mutations_by_sample():
     """
 
 
-def get_tgp_recurrent_mutations():
-    #filename = os.path.join(data_prefix, "1kg_chr20_ma0.1_ms0.01_p13.simplify.trees")
-    filename = os.path.join(
-            data_prefix,
-            "1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16.simplified.dated.insideoutside.trees")
-
-    ts = tskit.load(filename)
-    recurrent_counts, recurrent_counts_nosamples, sites_by_muts_nodouble, recurrent_counts_two_muts = get_recurrent_mutations(ts)
+def write_recurrent_mutations(filename, output_prefix, num_processes=1):
+    def compute():
+        ts = tskit.load(filename)
+        return dict(zip(
+            ["counts", "nosamples", "nodouble", "two_muts"],
+            get_recurrent_mutations(ts, num_processes=num_processes)))
+    # The name includes the output prefix so each dataset keeps its own entry
+    recurrent = utility.artifact_cache.get_columns(
+        "recurrent_mutations_" + os.path.basename(output_prefix), compute,
+        inputs=[filename])
+    recurrent_counts = recurrent["counts"]
+    recurrent_counts_nosamples = recurrent["nosamples"]
+    sites_by_muts_nodouble = recurrent["nodouble"]
+    recurrent_counts_two_muts = recurrent["two_muts"]
     df = pd.DataFrame(recurrent_counts, columns=["recurrent_counts"])
-    df.to_csv("data/1kg_chr20_ma0.1_ms0.1_p16.recurrent_counts.csv")
+    df.to_csv(output_prefix + ".recurrent_counts.csv")
     df = pd.DataFrame(recurrent_counts_nosamples, columns=["recurrent_counts_nosamples"])
-    df.to_csv("data/1kg_chr20_ma0.1_ms0.1_p16.recurrent_counts_nosamples.csv")
+    df.to_csv(output_prefix + ".recurrent_counts_nosamples.csv")
     df = pd.DataFrame(sites_by_muts_nodouble, columns=["recurrent_counts_nodouble"])
-    df.to_csv("data/1kg_chr20_ma0.1_ms0.1_p16.recurrent_counts_nodouble.csv")
+    df.to_csv(output_prefix + ".recurrent_counts_nodouble.csv")
 
     df = pd.DataFrame(recurrent_counts_two_muts, columns=["recurrent_counts_two_muts"])
-    df.to_csv("data/1kg_chr20_ma0.1_ms0.1_p16.recurrent_counts_nosamples_two_muts.csv")
-
-def get_hgdp_recurrent_mutations():
-    filename = os.path.join(data_prefix, "hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify.trees")
+    df.to_csv(output_prefix + ".recurrent_counts_nosamples_two_muts.csv")
 
-    ts = tskit.load(filename)
-    recurrent_counts, recurrent_counts_nosamples, sites_by_muts_nodouble, recurrent_counts_two_muts = get_recurrent_mutations(ts)
-    df = pd.DataFrame(recurrent_counts, columns=["recurrent_counts"])
-    df.to_csv("data/hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify.recurrent_counts.csv")
-    df = pd.DataFrame(recurrent_counts_nosamples, columns=["recurrent_counts_nosamples"])
-    df.to_csv("data/hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify.recurrent_counts_nosamples.csv")
-    df = pd.DataFrame(sites_by_muts_nodouble, columns=["recurrent_counts_nodouble"])
-    df.to_csv("data/hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify.recurrent_counts_nodouble.csv")
+def get_tgp_recurrent_mutations(num_processes=1):
+    #filename = os.path.join(data_prefix, "1kg_chr20_ma0.1_ms0.01_p13.simplify.trees")
+    filename = os.path.join(
+            data_prefix,
+            "1kg_chr20.iter.dated.binned_ma0.1_ms0.1_NNone_p16.simplified.dated.insideoutside.trees")
+    write_recurrent_mutations(
+        filename, "data/1kg_chr20_ma0.1_ms0.1_p16", num_processes=num_processes)
 
-    df = pd.DataFrame(recurrent_counts_two_muts, columns=["recurrent_counts_two_muts"])
-    df.to_csv("data/hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify.recurrent_counts_nosamples_two_muts.csv")
+def get_hgdp_recurrent_mutations(num_processes=1):
+    filename = os.path.join(data_prefix, "hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify.trees")
+    write_recurrent_mutations(
+        filename, "data/hgdp_missing_data_chr20_ma0.5_ms0.05_p15.simplify",
+        num_processes=num_processes)
 
-def get_sgdp_recurrent_mutations():
+def get_sgdp_recurrent_mutations(num_processes=1):
     filename = os.path.join(data_prefix, "sgdp_chr20.tsinferred.trees")
-
-    ts = tskit.load(filename)
-    recurrent_counts, recurrent_counts_nosamples, sites_by_muts_nodouble, recurrent_counts_two_muts = get_recurrent_mutations(ts)
-    df = pd.DataFrame(recurrent_counts, columns=["recurrent_counts"])
-    df.to_csv("data/sgdp_chr20.tsinferred.recurrent_counts.csv")
-    df = pd.DataFrame(recurrent_counts_nosamples, columns=["recurrent_counts_nosamples"])
-    df.to_csv("data/sgdp_chr20.tsinferred.recurrent_counts_nosamples.csv")
-    df = pd.DataFrame(sites_by_muts_nodouble, columns=["recurrent_counts_nodouble"])
-    df.to_csv("data/sgdp_chr20.tsinferred.recurrent_counts_nodouble.csv")
-
-    df = pd.DataFrame(recurrent_counts_two_muts, columns=["recurrent_counts_two_muts"])
-    df.to_csv("data/sgdp_chr20.tsinferred.recurrent_counts_nosamples_two_muts.csv")
+    write_recurrent_mutations(
+        filename, "data/sgdp_chr20.tsinferred", num_processes=num_processes)
 
 def min_site_times_ancients():
-    samples = tsinfer.load("all-data/1kg_ancients_noreich_chr20.samples")
-    min_times = samples.min_site_times(individuals_only=True)
-    df = pd.DataFrame(np.unique(min_times, return_counts=True))
+    samples_fn = "all-data/1kg_ancients_noreich_chr20.samples"
+
+    def compute():
+        samples = tsinfer.load(samples_fn)
+        min_times = samples.min_site_times(individuals_only=True)
+        values, counts = np.unique(min_times, return_counts=True)
+        return {"values": values, "counts": counts}
+    min_times = utility.artifact_cache.get_columns(
+        "min_site_times_ancients", compute, inputs=[samples_fn],
+        params={"individuals_only": True})
+    df = pd.DataFrame([min_times["values"], min_times["counts"]])
     df.to_csv("data/1kg_ancients_chr20_min_site_times.csv")
 
 
@@ -315,9 +444,15 @@ def main():
         description="Process the human data and make data files for plotting.")
     parser.add_argument(
         "name", type=str, help="figure name", choices=list(name_map.keys()))
+    parser.add_argument(
+        "--num-processes", type=int, default=1,
+        help="Number of worker processes used for the recurrent mutation summaries")
 
     args = parser.parse_args()
-    name_map[args.name]()
+    if args.name.startswith("recurrent_mutations"):
+        name_map[args.name](num_processes=args.num_processes)
+    else:
+        name_map[args.name]()
 
 
 if __name__ == "__main__":
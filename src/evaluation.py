@@ -85,9 +85,7 @@ def get_genetic_map_chr20_snippet(rowdata, filename):
     """
     For each chromosome 20 simulation, randomly select a region to run inference on
     """
-    species = stdpopsim.get_species("HomSap")
-    genetic_map = species.get_genetic_map("HapMapII_GRCh37")
-    cm = genetic_map.get_chromosome_map("chr20")
+    cm = utility.load_genetic_map(chrom="chr20")
     pos = np.array(cm.get_positions())
     snippet = np.where(
         np.logical_and(pos > rowdata["snippet"][0], pos < rowdata["snippet"][1])
@@ -402,26 +400,30 @@ def compare_mutation_msle_noancients(
     error_inferred_ts,
     error_dated_ts,
     error_iter_infer,
-    error_dated_ts_iter
+    error_dated_ts_iter,
+    sim_fn=None,
 ):
     """
     Compare mutation accuracy in iterative approach
+    If sim_fn is the path of the simulated tree sequence, its site times are cached
+    on disk so that repeat comparisons skip the tree walk.
     """
     for compare_ts in [inferred, dated_ts, iter_infer, dated_ts_iter, tsinfer_keep_times, tsdate_keep_times, tsdate_true_topo ]:
         assert np.array_equal(ts.tables.sites.position[:], compare_ts.tables.sites.position[:])
     for compare_ts in [error_inferred_ts, error_dated_ts, error_iter_infer, error_dated_ts_iter]:
         assert np.array_equal(sim_error_compatible.tables.sites.position[:], compare_ts.tables.sites.position[:])
 
-    real_time = tsdate.get_site_times(ts, unconstrained=False)
-    inferred_site_times = tsdate.get_site_times(inferred, unconstrained=False)
-    tsdate_time = tsdate.get_site_times(dated_ts)
-    iteration_time = tsdate.get_site_times(dated_ts_iter)
-    keep_site_times = tsdate.get_site_times(tsdate_keep_times)
-    simulated_topo_time = tsdate.get_site_times(tsdate_true_topo)
-    real_time_error = tsdate.get_site_times(sim_error_compatible, unconstrained=False)
-    error_inferred_time = tsdate.get_site_times(error_inferred_ts, unconstrained=False)
-    error_tsdate_time = tsdate.get_site_times(error_dated_ts)
-    error_iteration_time = tsdate.get_site_times(error_dated_ts_iter)
+    site_times = utility.get_tsdate_site_times
+    real_time = site_times(ts, unconstrained=False, trees_fn=sim_fn)
+    inferred_site_times = site_times(inferred, unconstrained=False)
+    tsdate_time = site_times(dated_ts)
+    iteration_time = site_times(dated_ts_iter)
+    keep_site_times = site_times(tsdate_keep_times)
+    simulated_topo_time = site_times(tsdate_true_topo)
+    real_time_error = site_times(sim_error_compatible, unconstrained=False)
+    error_inferred_time = site_times(error_inferred_ts, unconstrained=False)
+    error_tsdate_time = site_times(error_dated_ts)
+    error_iteration_time = site_times(error_dated_ts_iter)
     
     run_results = pd.DataFrame(
         [
@@ -482,11 +484,16 @@ def compare_mutations_iterative(
     tsinfer_keep_times,
     tsdate_keep_times,
     tsdate_true_topo,
+    sim_fn=None,
 ):
     """
     Compare mutation accuracy in iterative approach
+    If sim_fn is the path of the simulated tree sequence, its mutation ages are
+    cached on disk so that repeat comparisons skip the tree walk.
     """
-    simulated_df = utility.get_mut_pos_df(ts, "TrueTime", ts.tables.nodes.time[:])
+    simulated_df = utility.get_mut_pos_df(
+        ts, "TrueTime", ts.tables.nodes.time[:], trees_fn=sim_fn
+    )
     tsdate_df = utility.get_mut_pos_df(inferred, "tsdateTime", tsdate_dates)
     constr_df = utility.get_mut_pos_df(inferred, "ConstrainedTime", constrained_ages)
     iter_df = utility.get_mut_pos_df(iter_infer, "IterationTime", iter_dates)
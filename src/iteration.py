@@ -1,18 +1,22 @@
 import argparse
 import csv
+import gc
+import hashlib
 import numpy as np
 import json
+import multiprocessing
+import multiprocessing.connection
+import os
 import pickle
 import logging
 import pandas as pd
 import re
+import resource
 from tqdm import tqdm
 import time
 
-import msprime
 import tsinfer
 import tskit
-import stdpopsim
 
 import utility as util
 import evaluation
@@ -29,6 +33,146 @@ Input is a sampledata file with moderns (and optionally ancients).
 """
 
 
+# Files written by each step of iter_infer, as suffixes of output_fn
+STEP_OUTPUTS = {
+    "tsinferfirstpass": [".tsinferred.trees"],
+    "tsdatefirstpass": [".tsdatefirstpass.dates.p", ".tsdatefirstpass.trees"],
+    "constrainedsamples": [".constrained.samples", ".constrained.npz"],
+    "tsinfersecondpass": [".iter.tsinferred.trees"],
+    "tsdatesecondpass": [".tsdatesecondpass.dates.p", ".tsdatesecondpass.trees"],
+}
+
+
+def get_peak_rss():
+    """
+    Return the peak resident set size of this process so far, in bytes.
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StepProfile:
+    """
+    Wall time, CPU time, increase in peak RSS and output file sizes of each step of
+    iter_infer, written as JSON to output_fn + ".profile.json". The file is
+    rewritten as each step finishes, so a run that fails part way still leaves the
+    profile of the steps that completed.
+    """
+
+    def __init__(self, output_fn=None):
+        self.output_fn = output_fn
+        self.steps = []
+
+    def start(self):
+        self.wall_start = time.time()
+        self.cpu_start = time.process_time()
+        self.rss_start = get_peak_rss()
+
+    def stop(self, name):
+        peak_rss = get_peak_rss()
+        output_sizes = {}
+        if self.output_fn is not None:
+            for suffix in STEP_OUTPUTS[name]:
+                path = self.output_fn + suffix
+                if os.path.exists(path):
+                    output_sizes[path] = os.path.getsize(path)
+        self.steps.append(
+            {
+                "step": name,
+                "wall_time": time.time() - self.wall_start,
+                "cpu_time": time.process_time() - self.cpu_start,
+                "peak_rss": peak_rss,
+                "peak_rss_increase": peak_rss - self.rss_start,
+                "output_sizes": output_sizes,
+            }
+        )
+        self.write()
+        return self.steps[-1]["wall_time"]
+
+    def write(self):
+        if self.output_fn is not None:
+            with open(self.output_fn + ".profile.json", "w") as f:
+                json.dump({"steps": self.steps}, f, indent=2)
+
+
+def get_inputs_hash(inputs):
+    """
+    Return a hex digest identifying the inputs to a step: tree sequences by their
+    content, SampleData files by their uuid, arrays by their bytes, dicts of numbers
+    (such as the constrained site times) by their sorted keys and values as float64
+    bytes and anything else by its repr.
+    """
+    digest = hashlib.sha1()
+    for item in inputs:
+        if isinstance(item, tskit.TreeSequence):
+            digest.update(util.ts_content_hash(item).encode())
+        elif isinstance(item, tsinfer.SampleData):
+            digest.update(item.uuid.encode())
+        elif isinstance(item, np.ndarray):
+            digest.update(np.ascontiguousarray(item))
+        elif isinstance(item, dict):
+            # Keys are floats when computed but np.float64 when loaded, whose reprs
+            # differ, so hash their values
+            keys = sorted(item.keys())
+            values = [item[key] for key in keys]
+            digest.update(np.asarray(keys, dtype=np.float64).tobytes())
+            digest.update(np.asarray(values, dtype=np.float64).tobytes())
+        else:
+            digest.update(repr(item).encode())
+    return digest.hexdigest()
+
+
+def run_step(name, compute, load, inputs, params, output_fn=None, resume=False):
+    """
+    Run one step of iter_infer, recording a manifest of its input hash, parameters and
+    output files in output_fn + "." + name + ".manifest.json". compute() must write the
+    outputs, which are output_fn + suffix for each suffix in STEP_OUTPUTS[name]. If
+    resume is True and a manifest with the same inputs and parameters exists whose
+    outputs are unchanged on disk, the step is skipped and load(*output_paths) is
+    returned instead.
+    """
+    if output_fn is None:
+        return compute()
+    manifest_fn = output_fn + "." + name + ".manifest.json"
+    input_hash = get_inputs_hash(inputs)
+    params = json.loads(json.dumps(params, default=str))
+    output_paths = [output_fn + suffix for suffix in STEP_OUTPUTS[name]]
+    if resume and os.path.exists(manifest_fn):
+        with open(manifest_fn) as f:
+            manifest = json.load(f)
+        if (
+            manifest["input_hash"] == input_hash
+            and manifest["params"] == params
+            and all(os.path.exists(path) for path in output_paths)
+            and manifest["outputs"]
+            == [util.file_signature(path) for path in output_paths]
+        ):
+            print("Resuming: loading {} outputs from {}".format(name, manifest_fn))
+            return load(*output_paths)
+    result = compute()
+    manifest = {
+        "step": name,
+        "input_hash": input_hash,
+        "params": params,
+        "outputs": [util.file_signature(path) for path in output_paths],
+    }
+    with open(manifest_fn, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return result
+
+
+def load_pickle(filename):
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+def load_dated_sampledata(samples_fn, constrained_fn):
+    with np.load(constrained_fn) as data:
+        constr_mut_pos = dict(zip(data["constr_pos"], data["constr_ages"]))
+        constrained_ages = data["constrained_ages"]
+    return tsinfer.load(samples_fn), constr_mut_pos, constrained_ages
+
+
 def iter_infer(
     samples,
     Ne,
@@ -45,11 +189,25 @@ def iter_infer(
     return_trees=False,
     inferred_ts=None,
     progress=False,
+    resume=False,
+    time_binning="fixed",
+    bin_width=10,
+    num_bins=100,
+    low_memory=False,
 ):
     """
     Runs all steps in iterative approach.
     Input is a sampledata file (optionally with ancient samples).
+    If output_fn is given each step records a manifest, and with resume=True steps
+    whose inputs and parameters are unchanged are reloaded from disk (see run_step).
+    time_binning, bin_width and num_bins choose how site times are binned before
+    the second tsinfer pass (see bin_sampledata). If low_memory is True, each
+    intermediate is released once the steps using it are done, and reloaded from its
+    file under output_fn if it is needed again, so peak memory is that of the largest
+    step rather than of all of them.
     """
+    if low_memory and output_fn is None:
+        raise ValueError("low_memory requires an output_fn to write intermediates to")
 
     print(
         "Starting iterative approach with {} samples, {} sites, using {} mismatch_rate," 
@@ -57,22 +215,32 @@ def iter_infer(
             samples.num_samples, samples.num_sites, mismatch_rate, np.quantile(recombination_rate, 0.5), precision
         )
     )
+    profile = StepProfile(output_fn)
     # Step 1: tsinfer first pass
-    start = time.time()
+    profile.start()
+    infer_params = dict(mismatch_rate=mismatch_rate, precision=precision)
     if inferred_ts is None:
-        inferred_ts = tsinfer_first_pass(
-            samples,
+        inferred_ts = run_step(
+            "tsinferfirstpass",
+            lambda: tsinfer_first_pass(
+                samples,
+                output_fn=output_fn,
+                recombination_rate=recombination_rate,
+                mismatch_rate=mismatch_rate,
+                precision=precision,
+                num_threads=num_threads,
+                progress=progress,
+            ),
+            tskit.load,
+            [samples, np.asarray(recombination_rate)],
+            infer_params,
             output_fn=output_fn,
-            recombination_rate=recombination_rate,
-            mismatch_rate=mismatch_rate,
-            precision=precision,
-            num_threads=num_threads,
-            progress=progress,
+            resume=resume,
         )
     else:
         inferred_ts = tskit.load(inferred_ts)
-    end = time.time()
-    print("Step 1, Inferring Tree Sequence, done in {} minutes".format((end - start) / 60)
+    step_time = profile.stop("tsinferfirstpass")
+    print("Step 1, Inferring Tree Sequence, done in {} minutes".format(step_time / 60)
     )
 
 
@@ -81,42 +249,89 @@ def iter_infer(
         inferred_ts, centromere = run_snip_centromere_telomeres(inferred_ts, chrom)
 
     # Step 2: tsdate first pass
-    start = time.time()
-    tsdate_ages, modern_inferred_ts = tsdate_first_pass(
-        inferred_ts,
-        samples,
-        Ne,
-        mutation_rate,
+    profile.start()
+    date_params = dict(Ne=Ne, mutation_rate=mutation_rate)
+    tsdate_ages, modern_inferred_ts = run_step(
+        "tsdatefirstpass",
+        lambda: tsdate_first_pass(
+            inferred_ts,
+            samples,
+            Ne,
+            mutation_rate,
+            output_fn=output_fn,
+            num_threads=num_threads,
+            progress=progress,
+        ),
+        lambda dates_fn, ts_fn: (load_pickle(dates_fn), tskit.load(ts_fn)),
+        [inferred_ts, samples],
+        date_params,
         output_fn=output_fn,
-        num_threads=num_threads,
-        progress=progress,
+        resume=resume,
     )
-    end = time.time()
-    print("Step 2, Dating Tree Sequence, {} minutes".format((end - start) / 60))
+    step_time = profile.stop("tsdatefirstpass")
+    print("Step 2, Dating Tree Sequence, {} minutes".format(step_time / 60))
+    if low_memory:
+        del inferred_ts
+        gc.collect()
 
     # Step 3: Add dates to sampledata file
-    start = time.time()
-    samples_constrained, constr_mut_pos, constrained_ages = get_dated_sampledata(
-        samples, tsdate_ages, modern_inferred_ts, output_fn=output_fn
+    profile.start()
+    samples_constrained, constr_mut_pos, constrained_ages = run_step(
+        "constrainedsamples",
+        lambda: get_dated_sampledata(
+            samples, tsdate_ages, modern_inferred_ts, output_fn=output_fn
+        ),
+        load_dated_sampledata,
+        [samples, tsdate_ages, modern_inferred_ts],
+        {},
+        output_fn=output_fn,
+        resume=resume,
     )
-    end = time.time()
+    step_time = profile.stop("constrainedsamples")
     print(
-        "Step 3, Adding times to sampledata file, {} minutes".format((end - start) / 60)
+        "Step 3, Adding times to sampledata file, {} minutes".format(step_time / 60)
     )
+    if low_memory:
+        # Reloaded from output_fn + ".tsdatefirstpass.trees" at the end
+        del modern_inferred_ts
+        gc.collect()
 
     # Step 4: tsinfer second pass
-    start = time.time()
-    reinferred_ts = tsinfer_second_pass(
-        samples_constrained,
-        recombination_rate=recombination_rate,
-        mismatch_rate=mismatch_rate,
-        precision=precision,
+    profile.start()
+    reinferred_ts = run_step(
+        "tsinfersecondpass",
+        lambda: tsinfer_second_pass(
+            samples_constrained,
+            recombination_rate=recombination_rate,
+            mismatch_rate=mismatch_rate,
+            precision=precision,
+            output_fn=output_fn,
+            num_threads=num_threads,
+            progress=progress,
+            time_binning=time_binning,
+            bin_width=bin_width,
+            num_bins=num_bins,
+            low_memory=low_memory,
+        ),
+        tskit.load,
+        [samples_constrained, np.asarray(recombination_rate)],
+        dict(
+            infer_params,
+            time_binning=time_binning,
+            bin_width=bin_width,
+            num_bins=num_bins,
+        ),
         output_fn=output_fn,
-        num_threads=num_threads,
-        progress=progress,
+        resume=resume,
     )
-    end = time.time()
-    print("Step 4, Re-Inferring Tree Sequence, {} minutes".format((end - start) / 60))
+    step_time = profile.stop("tsinfersecondpass")
+    print("Step 4, Re-Inferring Tree Sequence, {} minutes".format(step_time / 60))
+    if low_memory:
+        # Step 5 only needs the sample times, so reopen the constrained samples
+        # from disk rather than keeping the copy used for step 4
+        del samples_constrained
+        gc.collect()
+        samples_constrained = tsinfer.load(output_fn + ".constrained.samples")
     print(
         "Re-Inferred ts has {} nodes, {} edges, {} mutations and {} trees".format(
             reinferred_ts.num_nodes,
@@ -131,24 +346,36 @@ def iter_infer(
         reinferred_ts, centromere = run_snip_centromere_telomeres(reinferred_ts, chrom)
 
     # Step 5: tsdate second pass
-    start = time.time()
-    iter_dates, modern_reinferred_ts = tsdate_second_pass(
-        reinferred_ts,
-        samples_constrained,
-        Ne,
-        mutation_rate,
+    profile.start()
+    iter_dates, modern_reinferred_ts = run_step(
+        "tsdatesecondpass",
+        lambda: tsdate_second_pass(
+            reinferred_ts,
+            samples_constrained,
+            Ne,
+            mutation_rate,
+            output_fn=output_fn,
+            constr_sites=constr_mut_pos,
+            adjust_priors=True,
+            num_threads=num_threads,
+            progress=progress,
+        ),
+        lambda dates_fn, ts_fn: (load_pickle(dates_fn), tskit.load(ts_fn)),
+        [reinferred_ts, samples_constrained, constr_mut_pos],
+        dict(date_params, adjust_priors=True),
         output_fn=output_fn,
-        constr_sites=constr_mut_pos,
-        adjust_priors=True,
-        num_threads=num_threads,
-        progress=progress,
+        resume=resume,
     )
-    end = time.time()
+    step_time = profile.stop("tsdatesecondpass")
     print(
         "Step 5, Dating Re-Inferred Tree Sequence, {} minutes".format(
-            (end - start) / 60
+            step_time / 60
         )
     )
+    if low_memory:
+        del reinferred_ts, samples_constrained
+        gc.collect()
+        modern_inferred_ts = tskit.load(output_fn + ".tsdatefirstpass.trees")
     if return_trees:
         inferred_dated_ts = get_dated_ts(modern_inferred_ts, tsdate_ages, Ne, 1e-6)
         reinferred_dated_ts = get_dated_ts(modern_reinferred_ts, iter_dates, Ne, 1e-6)
@@ -253,11 +480,12 @@ def tsdate_first_pass(
 
     tsdate_ages = tsdate_ages[0] * 2 * Ne
     tsdate_ages_df = util.get_mut_pos_df(
-        modern_inferred_ts, "FirstPassAges", tsdate_ages
+        modern_inferred_ts, "FirstPassAges", tsdate_ages, cache=None
     )
     if output_fn is not None:
         tsdate_ages_df.to_csv(output_fn + ".tsdatefirstpass.csv")
         pickle.dump(tsdate_ages, open(output_fn + ".tsdatefirstpass.dates.p", "wb"))
+        modern_inferred_ts.dump(output_fn + ".tsdatefirstpass.trees")
     logging.debug(
         "STEP TWO: Dated inferred tree sequence with {} mutations.".format(
             inferred_ts.num_mutations
@@ -266,6 +494,22 @@ def tsdate_first_pass(
     return tsdate_ages, modern_inferred_ts
 
 
+def get_ancient_bounds(sampledata, sample_ids, sample_ages):
+    """
+    Return the age of the oldest of the samples sample_ids (with ages sample_ages)
+    carrying the derived allele at each site, or NaN where none of them do. Only
+    those genotype columns are read, one chunk of sites at a time.
+    """
+    ancient_bound = np.full(sampledata.num_sites, np.nan)
+    if len(sample_ids) > 0:
+        for start, genos in util.genotype_chunks(sampledata, sample_ids):
+            carriers = genos == 1
+            chunk_bound = np.max(np.where(carriers, sample_ages, -np.inf), axis=1)
+            chunk_bound[~np.any(carriers, axis=1)] = np.nan
+            ancient_bound[start : start + genos.shape[0]] = chunk_bound
+    return ancient_bound
+
+
 def get_dated_sampledata(
     sampledata, tsdate_ages, inferred_ts, output_fn=None, centromere=None
 ):
@@ -280,24 +524,12 @@ def get_dated_sampledata(
     sampledata_ages = sampledata.individuals_time[:][sampledata.samples_individual[:]]
     ancient_samples_bool = sampledata_ages != 0
     ancient_ages = sampledata_ages[ancient_samples_bool] / constants.GENERATION_TIME
-    ancient_genotypes = sampledata.sites_genotypes[:][:, ancient_samples_bool]
-    ancient_sites_bool = np.any(ancient_genotypes == 1, axis=1)
-    ancient_genotypes = ancient_genotypes[ancient_sites_bool]
+    ancient_sample_ids = np.where(ancient_samples_bool)[0]
+    ancient_bound = get_ancient_bounds(sampledata, ancient_sample_ids, ancient_ages)
+    ancient_sites_bool = ~np.isnan(ancient_bound)
     ancient_positions = sampledata.sites_position[:][ancient_sites_bool]
     ancient_alleles = sampledata.sites_alleles[:][ancient_sites_bool]
-    ancient_mutations = [
-        (pos, np.max(ancient_ages[geno == 1]), alleles[0], alleles[1])
-        for pos, geno, alleles in zip(
-            ancient_positions, ancient_genotypes, ancient_alleles
-        )
-    ]
-    ancient_mut_df = pd.DataFrame(
-        ancient_mutations,
-        columns=["Position", "Ancient Bound", "Reference Allele", "Alternative Allele"],
-    )
-    ancient_mut_df = ancient_mut_df.astype(
-        {"Position": "float64", "Ancient Bound": "float64"}
-    )
+    ancient_bound = ancient_bound[ancient_sites_bool]
 
     mutation_table = inferred_ts.tables.mutations
     sites_table = inferred_ts.tables.sites
@@ -334,13 +566,23 @@ def get_dated_sampledata(
             sampledata_pos < centromere[0], sampledata_pos > centromere[1]
         )
         sampledata_alleles = sampledata.sites_alleles[:][keep_sites]
-    merged = pd.merge(
-        modern_mut_df,
-        ancient_mut_df,
-        how="left",
-        left_on=["Position", "Ancestral Allele", "Derived Allele"],
-        right_on=["Position", "Reference Allele", "Alternative Allele"],
-    )
+    # Align ancient sites to modern mutations by position, requiring matching alleles
+    merged = modern_mut_df.reset_index(drop=True)
+    merged["Ancient Bound"] = np.nan
+    if len(ancient_positions) > 0:
+        modern_pos = merged["Position"].values
+        ancient_index = np.searchsorted(ancient_positions, modern_pos)
+        ancient_index[ancient_index == len(ancient_positions)] = 0
+        ref_alleles = np.array([alleles[0] for alleles in ancient_alleles], dtype=object)
+        alt_alleles = np.array([alleles[1] for alleles in ancient_alleles], dtype=object)
+        matched = np.logical_and.reduce(
+            [
+                ancient_positions[ancient_index] == modern_pos,
+                ref_alleles[ancient_index] == merged["Ancestral Allele"].values,
+                alt_alleles[ancient_index] == merged["Derived Allele"].values,
+            ]
+        )
+        merged.loc[matched, "Ancient Bound"] = ancient_bound[ancient_index[matched]]
     merged["Constrained Age"] = np.fmax(
         merged["Estimated Age"], merged["Ancient Bound"]
     )
@@ -371,20 +613,227 @@ def get_dated_sampledata(
             merged["Constrained Age"][which_sites][constr_index],
         )
     )
-    # At sites with multiple mutations, only constrain oldest times
+    # At sites with multiple mutations, only constrain oldest times. As in merged,
+    # back mutations are ignored
     constrained_ages = np.copy(tsdate_ages)
-    for site in inferred_ts.sites():
-        oldest_mut_age = 0
-        oldest_mut_node = 0
-        for mut in site.mutations:
-            if constrained_ages[mut.node] > oldest_mut_age:
-                oldest_mut_age = constrained_ages[mut.node]
-                oldest_mut_node = mut.node
-        constrained_ages[mut.node] = merged["Constrained Age"][site.id]
+    oldest_muts = util.get_oldest_mutations(
+        mutation_table.site,
+        constrained_ages[mutation_table.node],
+        sites_table.num_rows,
+        mask=~util.get_back_mutations(inferred_ts.tables),
+    )
+    merged_pos = merged["Position"].values
+    site_index = np.searchsorted(merged_pos, sites_table.position)
+    in_merged = site_index < len(merged_pos)
+    in_merged[in_merged] = (
+        merged_pos[site_index[in_merged]] == sites_table.position[in_merged]
+    )
+    constrain = np.logical_and(in_merged, oldest_muts != -1)
+    constrained_ages[mutation_table.node[oldest_muts[constrain]]] = merged[
+        "Constrained Age"
+    ].values[site_index[constrain]]
+    if output_fn is not None:
+        np.savez(
+            output_fn + ".constrained.npz",
+            constr_pos=np.array(list(constr_mut_pos.keys()), dtype=np.float64),
+            constr_ages=np.array(list(constr_mut_pos.values()), dtype=np.float64),
+            constrained_ages=constrained_ages,
+        )
 
     return sampledata_copy, constr_mut_pos, constrained_ages
 
 
+def add_ancient_constraints(
+    samples, previous_fn, new_individuals=None, output_fn=None
+):
+    """
+    Update the constrained sampledata written by a previous iter_infer run with
+    output prefix previous_fn, using ancient individuals in samples which that run
+    did not have. samples must hold the same sites as the sampledata given to the
+    previous run, plus any new individuals. new_individuals defaults to the ancient
+    individuals added after those in the previous run. Lower bounds are only
+    computed for the new ancient genomes, and only the site times they raise are
+    changed. Returns the same values as get_dated_sampledata.
+    """
+    previous = tsinfer.load(previous_fn + ".constrained.samples")
+    modern_inferred_ts = tskit.load(previous_fn + ".tsdatefirstpass.trees")
+    with np.load(previous_fn + ".constrained.npz") as data:
+        constr_mut_pos = dict(zip(data["constr_pos"], data["constr_ages"]))
+        constrained_ages = data["constrained_ages"].copy()
+    individuals_time = samples.individuals_time[:]
+    if new_individuals is None:
+        new_individuals = np.arange(previous.num_individuals, samples.num_individuals)
+    new_individuals = np.asarray(new_individuals)
+    new_individuals = new_individuals[individuals_time[new_individuals] != 0]
+    samples_individual = samples.samples_individual[:]
+    new_sample_ids = np.where(np.isin(samples_individual, new_individuals))[0]
+    new_ages = individuals_time[samples_individual[new_sample_ids]] / (
+        constants.GENERATION_TIME
+    )
+    print(
+        "Adding {} ancient individuals ({} samples)".format(
+            len(new_individuals), len(new_sample_ids)
+        )
+    )
+    new_bound = get_ancient_bounds(samples, new_sample_ids, new_ages)
+
+    # Align the sites carried by the new ancients with the previous constrained sites
+    positions = samples.sites_position[:]
+    previous_pos = previous.sites_position[:]
+    carried = np.where(~np.isnan(new_bound))[0]
+    previous_index = np.searchsorted(previous_pos, positions[carried])
+    previous_index[previous_index == len(previous_pos)] = 0
+    found = previous_pos[previous_index] == positions[carried]
+    carried = carried[found]
+    previous_index = previous_index[found]
+    # As in get_dated_sampledata, the ancient alleles must match those of the oldest
+    # mutation (ignoring back mutations) at the site in the first pass tree sequence
+    tables = modern_inferred_ts.tables
+    oldest_muts = util.get_oldest_mutations(
+        tables.mutations.site,
+        constrained_ages[tables.mutations.node],
+        tables.sites.num_rows,
+        mask=~util.get_back_mutations(tables),
+    )
+    site_ids = np.searchsorted(tables.sites.position, positions[carried])
+    site_ids[site_ids == tables.sites.num_rows] = 0
+    oldest_muts = oldest_muts[site_ids]
+    matched = np.logical_and(
+        tables.sites.position[site_ids] == positions[carried], oldest_muts != -1
+    )
+    if np.any(matched):
+        ancestral_alleles = np.array(
+            tskit.unpack_strings(
+                tables.sites.ancestral_state, tables.sites.ancestral_state_offset
+            ),
+            dtype=object,
+        )
+        derived_alleles = np.array(
+            tskit.unpack_strings(
+                tables.mutations.derived_state, tables.mutations.derived_state_offset
+            ),
+            dtype=object,
+        )
+        sites_alleles = samples.sites_alleles[:]
+        ref_alleles = np.array(
+            [sites_alleles[site][0] for site in carried[matched]], dtype=object
+        )
+        alt_alleles = np.array(
+            [sites_alleles[site][1] for site in carried[matched]], dtype=object
+        )
+        matched[matched] = np.logical_and(
+            ref_alleles == ancestral_alleles[site_ids[matched]],
+            alt_alleles == derived_alleles[oldest_muts[matched]],
+        )
+    carried = carried[matched]
+    previous_index = previous_index[matched]
+    oldest_muts = oldest_muts[matched]
+    site_times = previous.sites_time[:]
+    # sites_time holds the constrained age plus one
+    previous_age = site_times[previous_index] - 1
+    raised = new_bound[carried] > previous_age
+    carried = carried[raised]
+    previous_index = previous_index[raised]
+    oldest_muts = oldest_muts[raised]
+    site_times[previous_index] = new_bound[carried] + 1
+    print("Raised the times of {} sites".format(len(carried)))
+
+    other_sites = ~np.isin(positions, previous_pos)
+    if np.any(other_sites):
+        samples = samples.delete(sites=other_sites)
+    if output_fn is not None:
+        samples_constrained = samples.copy(output_fn + ".constrained.samples")
+    else:
+        samples_constrained = samples.copy()
+    samples_constrained.sites_time[:] = site_times
+    samples_constrained.finalise()
+
+    # Record the new constraints, and constrain the oldest mutation at each site
+    constr_mut_pos.update(zip(positions[carried], new_bound[carried]))
+    constrained_ages[tables.mutations.node[oldest_muts]] = new_bound[carried]
+    if output_fn is not None:
+        np.savez(
+            output_fn + ".constrained.npz",
+            constr_pos=np.array(list(constr_mut_pos.keys()), dtype=np.float64),
+            constr_ages=np.array(list(constr_mut_pos.values()), dtype=np.float64),
+            constrained_ages=constrained_ages,
+        )
+    return samples_constrained, constr_mut_pos, constrained_ages
+
+
+def iter_infer_add_ancients(
+    samples,
+    previous_fn,
+    Ne,
+    mutation_rate,
+    new_individuals=None,
+    mismatch_rate=None,
+    precision=None,
+    recombination_rate=None,
+    num_threads=1,
+    output_fn=None,
+    chrom=None,
+    progress=False,
+    time_binning="fixed",
+    bin_width=10,
+    num_bins=100,
+):
+    """
+    Add newly sequenced ancient samples to a previous iter_infer run with output
+    prefix previous_fn, without repeating its first tsinfer and tsdate passes. Site
+    times are updated from the new ancients only (see add_ancient_constraints), then
+    the second tsinfer and tsdate passes are rerun. Returns the same values as
+    iter_infer.
+    """
+    profile = StepProfile(output_fn)
+    profile.start()
+    samples_constrained, constr_mut_pos, constrained_ages = add_ancient_constraints(
+        samples, previous_fn, new_individuals=new_individuals, output_fn=output_fn
+    )
+    step_time = profile.stop("constrainedsamples")
+    print("Adding ancient constraints, {} minutes".format(step_time / 60))
+
+    profile.start()
+    reinferred_ts = tsinfer_second_pass(
+        samples_constrained,
+        recombination_rate=recombination_rate,
+        mismatch_rate=mismatch_rate,
+        precision=precision,
+        output_fn=output_fn,
+        num_threads=num_threads,
+        progress=progress,
+        time_binning=time_binning,
+        bin_width=bin_width,
+        num_bins=num_bins,
+    )
+    step_time = profile.stop("tsinfersecondpass")
+    print("Re-Inferring Tree Sequence, {} minutes".format(step_time / 60))
+    if chrom is not None:
+        reinferred_ts, centromere = run_snip_centromere_telomeres(reinferred_ts, chrom)
+
+    profile.start()
+    iter_dates, modern_reinferred_ts = tsdate_second_pass(
+        reinferred_ts,
+        samples_constrained,
+        Ne,
+        mutation_rate,
+        output_fn=output_fn,
+        constr_sites=constr_mut_pos,
+        adjust_priors=True,
+        num_threads=num_threads,
+        progress=progress,
+    )
+    step_time = profile.stop("tsdatesecondpass")
+    print("Dating Re-Inferred Tree Sequence, {} minutes".format(step_time / 60))
+    return (
+        tskit.load(previous_fn + ".tsdatefirstpass.trees"),
+        load_pickle(previous_fn + ".tsdatefirstpass.dates.p"),
+        constrained_ages,
+        modern_reinferred_ts,
+        iter_dates,
+    )
+
+
 def ancients_as_ancestors(sample_data, ancestor_data, output_fn=None, progress=False):
     """
     Insert ancient samples in sample_data file as ancestors in ancestor_data.
@@ -408,11 +857,14 @@ def ancients_as_ancestors(sample_data, ancestor_data, output_fn=None, progress=F
     add_ancient_indices = np.searchsorted(
         -ancestor_data.ancestors_time[:], -ancient_ages[argsort_ancients]
     )
-    ancient_haplos = list()
-
-    for haplo in sample_data.haplotypes():
-        if haplo[0] in ancient_samples:
-            ancient_haplos.append(haplo[1][sample_data.sites_inference[:]])
+    # Read only the ancient columns at inference sites, one chunk of sites at a time
+    inference_sites = sample_data.sites_inference[:]
+    ancient_haplos = np.concatenate(
+        [
+            genos[inference_sites[start : start + genos.shape[0]]]
+            for start, genos in util.genotype_chunks(sample_data, ancient_samples)
+        ]
+    ).T
     if output_fn is not None:
         output_fn = output_fn + ".ancients_added.ancestors"
     with tsinfer.AncestorData(
@@ -421,25 +873,35 @@ def ancients_as_ancestors(sample_data, ancestor_data, output_fn=None, progress=F
         index = 0
         added_ancients_indices = list()
         added_ancients_metadata = list()
+
+        def add_ancients_up_to(cur_index, next_ancient, index):
+            # Two-pointer merge: add_ancient_indices is sorted, so add every ancient
+            # which goes before ancestor cur_index and advance past it
+            while (
+                next_ancient < len(add_ancient_indices)
+                and add_ancient_indices[next_ancient] <= cur_index
+            ):
+                # Use correct index into ancients (so they are sorted)
+                ancient_index = argsort_ancients[next_ancient]
+                add_ancient_ancestor(
+                    ancestor_data_ancients,
+                    ancient_ages[ancient_index],
+                    ancient_haplos[ancient_index],
+                )
+                added_ancients_indices.append(index)
+                added_ancients_metadata.append(ancient_metadata[ancient_index])
+                index += 1
+                next_ancient += 1
+            return next_ancient, index
+
+        next_ancient = 0
         for cur_index, ancestor in tqdm(
             enumerate(ancestor_data.ancestors()),
             total=ancestor_data.num_ancestors,
             disable=not progress,
             desc="Add ancient ancestors",
         ):
-            if cur_index in add_ancient_indices:
-                for ancient_index in np.where(cur_index == add_ancient_indices)[0]:
-                    # Add ancient sample as ancestor at appropriate time
-                    # Use correct index into ancients (so they are sorted)
-                    ancient_index = argsort_ancients[ancient_index]
-                    add_ancient_ancestor(
-                        ancestor_data_ancients,
-                        ancient_ages[ancient_index],
-                        ancient_haplos[ancient_index],
-                    )
-                    added_ancients_indices.append(index)
-                    added_ancients_metadata.append(ancient_metadata[ancient_index])
-                    index += 1
+            next_ancient, index = add_ancients_up_to(cur_index, next_ancient, index)
             ancestor_data_ancients.add_ancestor(
                 ancestor.start,
                 ancestor.end,
@@ -448,17 +910,10 @@ def ancients_as_ancestors(sample_data, ancestor_data, output_fn=None, progress=F
                 ancestor.haplotype,
             )
             index += 1
-        if cur_index + 1 in add_ancient_indices:
-            for ancient_index in np.where(cur_index + 1 == add_ancient_indices)[0]:
-                ancient_index = argsort_ancients[ancient_index]
-                add_ancient_ancestor(
-                    ancestor_data_ancients,
-                    ancient_ages[ancient_index],
-                    ancient_haplos[ancient_index],
-                )
-                added_ancients_indices.append(index)
-                added_ancients_metadata.append(ancient_metadata[ancient_index])
-                index += 1
+        # Ancients younger than every ancestor go at the end
+        next_ancient, index = add_ancients_up_to(
+            ancestor_data.num_ancestors, next_ancient, index
+        )
     assert ancestor_data_ancients.num_ancestors == (
         ancestor_data.num_ancestors + len(ancient_samples)
     ), (
@@ -488,29 +943,34 @@ def tsinfer_second_pass(
     output_fn=None,
     num_threads=1,
     progress=False,
+    time_binning="fixed",
+    bin_width=10,
+    num_bins=100,
+    low_memory=False,
 ):
     """
     When reinfering the tree sequence, we now use the ancient samples as ancestors
+    If low_memory is True, ancestors are written to file rather than held in memory
+    and each intermediate is released as soon as it has been used.
     """
 
     def add_ancestors_flags(ts, added_ancients_indices, added_ancients_metadata):
-        for index, node in enumerate(ts.tables.nodes):
-            if node.flags & tsinfer.constants.NODE_IS_PC_ANCESTOR:
-                added_ancients_indices[added_ancients_indices > index] += 1
         tables = ts.dump_tables()
+        # Ancestor indices do not count path compression nodes, so map each one to
+        # the first node preceded by that many non-PC nodes
+        non_pc = (tables.nodes.flags & tsinfer.constants.NODE_IS_PC_ANCESTOR) == 0
+        num_non_pc_before = np.concatenate(([0], np.cumsum(non_pc)))
+        ancient_nodes = np.searchsorted(num_non_pc_before, added_ancients_indices)
         flag_array = tables.nodes.flags.copy()
-        metadata_array = tskit.unpack_bytes(
-            tables.nodes.metadata, tables.nodes.metadata_offset
+        flag_array[ancient_nodes] |= flag_array.dtype.type(
+            tsinfer.NODE_IS_SAMPLE_ANCESTOR | tskit.NODE_IS_SAMPLE
+        )
+        md, md_offset = util.replace_metadata(
+            tables.nodes.metadata,
+            tables.nodes.metadata_offset,
+            ancient_nodes,
+            [json.dumps(metadata).encode() for metadata in added_ancients_metadata],
         )
-        for index, ancestor_index in enumerate(added_ancients_indices):
-            flag_array[ancestor_index] = np.bitwise_or(
-                flag_array[ancestor_index],
-                np.bitwise_or(tsinfer.NODE_IS_SAMPLE_ANCESTOR, tskit.NODE_IS_SAMPLE),
-            )
-            metadata_array[ancestor_index] = json.dumps(
-                added_ancients_metadata[index]
-            ).encode()
-        md, md_offset = tskit.pack_bytes(metadata_array)
         tables.nodes.set_columns(
             flags=flag_array,
             time=tables.nodes.time,
@@ -526,14 +986,23 @@ def tsinfer_second_pass(
     else:
         progress = None
     # We bin the sites time for efficiency
-    binned_sd = bin_sampledata(samples_constrained, output_fn)
-    ancestors_data = tsinfer.generate_ancestors(
-        binned_sd, num_threads=num_threads, progress_monitor=progress
+    binned_sd = bin_sampledata(
+        samples_constrained,
+        output_fn,
+        time_binning=time_binning,
+        bin_width=bin_width,
+        num_bins=num_bins,
     )
     if output_fn is not None:
         output_str = output_fn + ".ancestors"
     else:
         output_str = None
+    ancestors_data = tsinfer.generate_ancestors(
+        binned_sd,
+        num_threads=num_threads,
+        progress_monitor=progress,
+        path=output_str if low_memory else None,
+    )
     # If there are ancient samples, add them as ancestors
     if np.any(samples_constrained.individuals_time[:] > 0):
         ancients_present = True
@@ -547,6 +1016,8 @@ def tsinfer_second_pass(
         ) = ancients_as_ancestors(
             binned_sd, ancestors_data, output_fn, progress=progress
         )
+        if low_memory:
+            gc.collect()
     extra_params = dict(
         num_threads=num_threads,
         recombination_rate=recombination_rate,
@@ -566,6 +1037,9 @@ def tsinfer_second_pass(
         )
     if output_fn is not None:
         inferred_anc_ts.dump(output_fn + ".iter.tsinferred.atrees")
+    if low_memory:
+        del ancestors_data
+        gc.collect()
 #    if ancients_present:
 #        ancient_samples = np.where(binned_sd.individuals_time[:][binned_sd.samples_individual] != 0)[0]
 #        print("Matching Samples without the following ancient samples: {}".format(ancient_samples))
@@ -580,15 +1054,17 @@ def tsinfer_second_pass(
         simplify=False,
         **extra_params,
     )
-    if output_fn is not None:
-        iter_infer.dump(output_fn + ".iter.tsinferred.trees")
-
     logging.debug(
         "STEP FOUR: Reinferred tree sequence with {} modern samples and {} ancients.".format(
             np.sum(modern_samples_constrained.individuals_time[:] == 0),
             np.sum(modern_samples_constrained.individuals_time[:] != 0),
         )
     )
+    if low_memory:
+        del binned_sd, modern_samples_constrained, inferred_anc_ts
+        gc.collect()
+    if output_fn is not None:
+        iter_infer.dump(output_fn + ".iter.tsinferred.trees")
     return iter_infer
 
 
@@ -621,40 +1097,47 @@ def tsdate_second_pass(
     # If there are no ancient samples, don't adjust priors
     if np.all(samples.individuals_time[:] == 0):
         adjust_priors = False
+    scaled_timepoints = priors.timepoints * 2 * Ne
     if adjust_priors and constr_sites is not None:
-        inferred_times = modern_inferred_ts.tables.nodes.time[:]
-        for mut_pos, limit in constr_sites.items():
-            constrained_mutations_nodes = modern_inferred_ts.tables.mutations.node[
-                np.where(
-                    modern_inferred_ts.tables.sites.position[
-                        modern_inferred_ts.tables.mutations.site
-                    ]
-                    == mut_pos
-                )[0]
-            ]
-            # Only constrain the oldest mutation at this site
-            oldest_mut_age = 0
-            oldest_mut_node = 0
-            for mut_node in constrained_mutations_nodes:
-                if inferred_times[mut_node] > oldest_mut_age:
-                    oldest_mut_age = inferred_times[mut_node]
-                    oldest_mut_node = mut_node
-
-            # Only constrain mutations which are not above sample nodes
-            if inferred_times[mut_node] > 0:
-                priors.grid_data[
-                    mut_node - modern_inferred_ts.num_samples,
-                    : (np.abs(priors.timepoints * 2 * Ne - limit)).argmin(),
-                ] = 0
+        tables = modern_inferred_ts.tables
+        inferred_times = tables.nodes.time
+        num_samples = modern_inferred_ts.num_samples
+        # Map each constrained position to the node of the oldest mutation at its site
+        constr_pos = np.array(list(constr_sites.keys()), dtype=np.float64)
+        limits = np.array(list(constr_sites.values()), dtype=np.float64)
+        site_ids = np.searchsorted(tables.sites.position, constr_pos)
+        found = site_ids < tables.sites.num_rows
+        found[found] = tables.sites.position[site_ids[found]] == constr_pos[found]
+        oldest_muts = util.get_oldest_mutations(
+            tables.mutations.site,
+            inferred_times[tables.mutations.node],
+            tables.sites.num_rows,
+        )[site_ids[found]]
+        limits = limits[found][oldest_muts != -1]
+        constr_nodes = tables.mutations.node[oldest_muts[oldest_muts != -1]]
+        # Only constrain mutations which are not above sample nodes
+        above_sample = inferred_times[constr_nodes] > 0
+        constr_nodes = constr_nodes[above_sample]
+        limit_index = nearest_timepoints(scaled_timepoints, limits[above_sample])
+        if len(constr_nodes) > 0:
+            # Where several sites share a node, the largest constraint applies
+            rows, inverse = np.unique(constr_nodes - num_samples, return_inverse=True)
+            row_limits = np.zeros(len(rows), dtype=limit_index.dtype)
+            np.maximum.at(row_limits, inverse, limit_index)
+            grid = priors.grid_data[rows]
+            grid[np.arange(grid.shape[1]) < row_limits[:, np.newaxis]] = 0
+            # Renormalise, putting all the mass on the oldest timepoint if none is left
+            totals = np.sum(grid, axis=1)
+            grid[totals == 0, -1] = 1
+            totals[totals == 0] = 1
+            priors.grid_data[rows] = grid / totals[:, np.newaxis]
         added_ancestors = np.where(
-            modern_inferred_ts.tables.nodes.flags & tsinfer.NODE_IS_SAMPLE_ANCESTOR
+            tables.nodes.flags & tsinfer.NODE_IS_SAMPLE_ANCESTOR
         )[0]
-        for added_anc in added_ancestors:
-            ancient_time = modern_inferred_ts.tables.nodes.time[added_anc]
-            priors.grid_data[
-                added_anc - modern_inferred_ts.num_samples,
-                (np.abs(priors.timepoints * 2 * Ne - ancient_time)).argmin(),
-            ] = 1
+        priors.grid_data[
+            added_ancestors - num_samples,
+            nearest_timepoints(scaled_timepoints, inferred_times[added_ancestors]),
+        ] = 1
     iter_dates = tsdate.get_dates(
         modern_inferred_ts,
         Ne,
@@ -664,22 +1147,24 @@ def tsdate_second_pass(
         progress=progress,
     )
     tsdate_ages_df = util.get_mut_pos_df(
-        modern_inferred_ts, "SecondPassDates", iter_dates[0] * 2 * Ne
+        modern_inferred_ts, "SecondPassDates", iter_dates[0] * 2 * Ne, cache=None
     )
     if output_fn is not None:
         tsdate_ages_df.to_csv(output_fn + ".tsdatesecondpass.csv")
         pickle.dump(iter_dates[0] * 2 * Ne, open(output_fn + ".tsdatesecondpass.dates.p", "wb"))
+        modern_inferred_ts.dump(output_fn + ".tsdatesecondpass.trees")
     # Ensure that all dates are greater than the timepoint closest to the lower
     # bound ancient time constraint
     if constr_sites is not None:
-        constr_site_timepoint = {
-            pos: (priors.timepoints * 2 * Ne)[
-                (np.abs(priors.timepoints * 2 * Ne - time)).argmin()
-            ]
-            for pos, time in constr_sites.items()
-        }
+        constr_times = np.array(list(constr_sites.values()), dtype=np.float64)
+        constr_site_timepoint = dict(
+            zip(
+                constr_sites.keys(),
+                scaled_timepoints[nearest_timepoints(scaled_timepoints, constr_times)],
+            )
+        )
         # Remove singletons
-        tsdate_ages_df = tsdate_ages_df.loc[iter_dates[0][tsdate_ages_df["Node"]] > 0]
+        tsdate_ages_df = tsdate_ages_df.loc[tsdate_ages_df["SecondPassDates"] > 0]
         tsdate_ages_df.to_csv(output_fn + ".tsdatesecondpass.nosingletons.csv")
         assert np.all(
             [
@@ -699,34 +1184,115 @@ def tsdate_second_pass(
     return iter_dates, modern_inferred_ts
 
 
-def bin_sampledata(sampledata, output_fn=None):
+def nearest_timepoints(timepoints, times):
+    """
+    Return the index of the closest of the (increasing) timepoints to each of times,
+    taking the lower index on ties as np.argmin would.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    upper = np.clip(np.searchsorted(timepoints, times), 1, len(timepoints) - 1)
+    lower = upper - 1
+    use_lower = np.abs(times - timepoints[lower]) <= np.abs(timepoints[upper] - times)
+    return np.where(use_lower, lower, upper)
+
+
+def _bin_means(times, edges):
+    """
+    Replace each of times by the mean of the times falling in the same bin.
+    """
+    num_bins = len(edges) - 1
+    bins = np.clip(np.searchsorted(edges, times, side="right") - 1, 0, num_bins - 1)
+    counts = np.bincount(bins, minlength=num_bins)
+    sums = np.bincount(bins, weights=times, minlength=num_bins)
+    means = sums / np.maximum(counts, 1)
+    return means[bins]
+
+
+def fixed_width_bins(times, bin_width=10, num_bins=None):
+    """
+    Round times to the nearest multiple of bin_width.
+    """
+    return np.round(times / bin_width) * bin_width
+
+
+def log_bins(times, bin_width=None, num_bins=100):
+    """
+    Bin times into num_bins log-spaced bins between the smallest and largest time.
+    """
+    if len(times) == 0 or np.min(times) == np.max(times):
+        return times
+    edges = np.geomspace(np.min(times), np.max(times), num_bins + 1)
+    return _bin_means(times, edges)
+
+
+def quantile_bins(times, bin_width=None, num_bins=100):
+    """
+    Bin times into at most num_bins bins holding roughly equal numbers of times.
+    """
+    if len(times) == 0:
+        return times
+    edges = np.unique(np.quantile(times, np.linspace(0, 1, num_bins + 1)))
+    if len(edges) < 2:
+        return times
+    return _bin_means(times, edges)
+
+
+# Strategies for binning site times in bin_sampledata, called with the times to bin
+# and the bin_width and num_bins keyword arguments
+TIME_BINNING = {
+    "fixed": fixed_width_bins,
+    "log": log_bins,
+    "quantile": quantile_bins,
+}
+
+
+def bin_sampledata(
+    sampledata, output_fn=None, time_binning="fixed", bin_width=10, num_bins=100
+):
+    """
+    Copy sampledata, setting unspecified site times at inference sites to the
+    frequency of derived alleles, and bin all times greater than 5 using one of the
+    TIME_BINNING strategies. Fewer distinct times make match_ancestors faster.
+    """
     if output_fn is not None:
         sd = sampledata.copy(output_fn + ".binned.samples")
     else:
         sd = sampledata.copy()
 
     times = sd.sites_time[:]
-
-    for j, variant in enumerate(sd.variants(inference_sites=True)):
-        time = variant.site.time
-        if time == tsinfer.constants.TIME_UNSPECIFIED:
-            counts = tsinfer.formats.allele_counts(variant.genotypes)
-            # Non-variable sites have no obvious freq-as-time values
-            assert counts.known != counts.derived
-            assert counts.known != counts.ancestral
-            assert counts.known > 0
-            # Time = freq of *all* derived alleles. Note that if n_alleles > 2 this
-            # may not be sensible: https://github.com/tskit-dev/tsinfer/issues/228
-            times[variant.site.id] = counts.derived / counts.known
-
-    # Round times to the nearest 10, excluding times less than 5
-    times[times > 5] = np.round(times[times > 5], -1)
+    inference_sites = sd.sites_inference[:]
+    unspecified = np.logical_and(
+        inference_sites, times == tsinfer.constants.TIME_UNSPECIFIED
+    )
+    # Only read chunks with unspecified times; after step 3 every site has a time,
+    # so no genotypes are read at all
+    for start, genotypes in util.genotype_chunks(sd, site_mask=unspecified):
+        stop = start + genotypes.shape[0]
+        chunk_unspecified = unspecified[start:stop]
+        genotypes = genotypes[chunk_unspecified]
+        known = np.sum(genotypes != tskit.MISSING_DATA, axis=1)
+        derived = np.sum(genotypes > 0, axis=1)
+        # Non-variable sites have no obvious freq-as-time values
+        assert np.all(known != derived)
+        assert np.all(derived > 0)
+        assert np.all(known > 0)
+        # Time = freq of *all* derived alleles. Note that if n_alleles > 2 this
+        # may not be sensible: https://github.com/tskit-dev/tsinfer/issues/228
+        times[start + np.where(chunk_unspecified)[0]] = derived / known
+
+    # Bin times, excluding times less than 5
+    binned = times > 5
+    times[binned] = TIME_BINNING[time_binning](
+        times[binned], bin_width=bin_width, num_bins=num_bins
+    )
     sd.sites_time[:] = times
     print(
         "Number of samples:",
         sd.num_samples,
         ". Number of discrete times:",
-        len(np.unique(sd.sites_time[:])),
+        len(np.unique(times)),
+        ". Number of distinct ancestor times after {} binning:".format(time_binning),
+        len(np.unique(times[inference_sites])),
     )
     sd.finalise()
     return sd
@@ -765,13 +1331,10 @@ def setup_sample_file(args):
     if chrom or map is not None:
         if map is not None:
             print(f"Using {map} for the recombination map")
-            chr_map = msprime.RecombinationMap.read_hapmap(map)
+            chr_map = util.load_genetic_map(hapmap_fn=map)
         else:
             print(f"Using {chrom} from HapMapII_GRCh37 for the recombination map")
-            map = stdpopsim.get_species("HomSap").get_genetic_map(id="HapMapII_GRCh37")
-            if not map.is_cached():
-                map.download()
-            chr_map = map.get_chromosome_map(chrom)
+            chr_map = util.load_genetic_map(chrom=chrom)
         inference_distances = physical_to_genetic(chr_map, inference_pos)
         d = np.diff(inference_distances)
         rho = np.concatenate(([0.0], d))
@@ -784,12 +1347,7 @@ def setup_sample_file(args):
 
 
 def physical_to_genetic(recombination_map, input_physical_positions):
-    map_pos = recombination_map.get_positions()
-    map_rates = recombination_map.get_rates()
-    map_genetic_positions = np.insert(
-        np.cumsum(np.diff(map_pos) * map_rates[:-1]), 0, 0
-    )
-    return np.interp(input_physical_positions, map_pos, map_genetic_positions)
+    return util.physical_to_genetic(recombination_map, input_physical_positions)
 
 
 def run_snip_centromere_telomeres(ts, chrom):
@@ -843,11 +1401,18 @@ def main():
     parser.add_argument(
         "sampledata_file",
         type=str,
+        nargs="+",
         help="Input sampledata to infer. \
             Be sure that any ancient samples are set to their estimated \
-            age in years.",
+            age in years. If several files are given (e.g. one per chromosome) \
+            they are inferred concurrently.",
+    )
+    parser.add_argument(
+        "output",
+        type=str,
+        help="Output dated tree sequence. With several sampledata files, the prefix "
+        "for the outputs of each, which are named after their chromosome.",
     )
-    parser.add_argument("output", type=str, help="Output dated tree sequence.")
     parser.add_argument("Ne", type=int, help="Estimated effective population size.")
     parser.add_argument("mutation_rate", type=float, help="Estimated mutation rate.")
     parser.add_argument(
@@ -884,10 +1449,90 @@ def main():
             If user already has an inferred ts to perform iteration on. \
             This causes the first step to be skipped",
     )
-    parser.add_argument("--num-threads", type=int, default=16)
+    parser.add_argument(
+        "--num-threads",
+        type=int,
+        default=16,
+        help="Number of threads, shared between all runs when several sampledata "
+        "files are given.",
+    )
+    parser.add_argument(
+        "--threads-per-job",
+        type=int,
+        default=None,
+        help="Threads for each of several concurrent runs. Default: num-threads "
+        "divided by the number of sampledata files.",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=float,
+        default=None,
+        help="Memory budget in GB for concurrent runs. Default: unlimited.",
+    )
+    parser.add_argument(
+        "--memory-factor",
+        type=float,
+        default=8,
+        help="Estimated bytes of memory used per genotype (sites x samples) by a run, "
+        "used with --max-memory.",
+    )
     parser.add_argument("--progress", action="store_true", help="Show progress bar.")
+    parser.add_argument(
+        "--time-binning",
+        choices=list(TIME_BINNING.keys()),
+        default="fixed",
+        help="How to bin site times before the second tsinfer pass.",
+    )
+    parser.add_argument(
+        "--bin-width",
+        type=float,
+        default=10,
+        help="Width of the bins used by the fixed time binning, in generations.",
+    )
+    parser.add_argument(
+        "--num-bins",
+        type=int,
+        default=100,
+        help="Maximum number of bins used by the log and quantile time binning.",
+    )
+    parser.add_argument(
+        "--add-ancients",
+        type=str,
+        default=None,
+        help="Output prefix of a previous run. The sampledata file holds the samples "
+        "of that run plus newly added ancient individuals, whose constraints are "
+        "added before rerunning only the second tsinfer and tsdate passes.",
+    )
+    parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="Release intermediate tree sequences and ancestors between steps, "
+        "reloading them from the output files when needed.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip any step whose inputs and parameters match its manifest from a "
+        "previous run with the same output, reloading its outputs instead.",
+    )
 
     args = parser.parse_args()
+    if len(args.sampledata_file) == 1:
+        args.sampledata_file = args.sampledata_file[0]
+        run_chromosome(args)
+    else:
+        # These name the outputs of a single earlier run, so can't be shared
+        if args.inferred_ts is not None:
+            parser.error("--inferred-ts can only be used with one sampledata file")
+        if args.add_ancients is not None:
+            parser.error("--add-ancients can only be used with one sampledata file")
+        run_chromosomes(args)
+
+
+def run_chromosome(args):
+    """
+    Run iter_infer on the single sampledata file args.sampledata_file.
+    """
     sampledata, rho, prefix, chrom = setup_sample_file(args)
     av_rho = np.quantile(rho, 0.5)
 
@@ -908,6 +1553,24 @@ def main():
         precision = args.precision
 
     print(np.quantile(rho, 0.5))
+    if args.add_ancients is not None:
+        iter_infer_add_ancients(
+            sampledata,
+            args.add_ancients,
+            args.Ne,
+            args.mutation_rate,
+            output_fn=args.output,
+            recombination_rate=rho,
+            mismatch_rate=mismatch_rate,
+            precision=precision,
+            chrom=chrom,
+            progress=args.progress,
+            num_threads=args.num_threads,
+            time_binning=args.time_binning,
+            bin_width=args.bin_width,
+            num_bins=args.num_bins,
+        )
+        return
     iter_infer(
         sampledata,
         args.Ne,
@@ -920,8 +1583,85 @@ def main():
         chrom=chrom,
         progress=args.progress,
         num_threads=args.num_threads,
+        resume=args.resume,
+        time_binning=args.time_binning,
+        bin_width=args.bin_width,
+        num_bins=args.num_bins,
+        low_memory=args.low_memory,
     )
 
 
+def get_chromosome_output(output, filename):
+    """
+    Return the output prefix used for one of several sampledata files, naming it
+    after the chromosome in the filename if there is one.
+    """
+    match = re.search(r"(chr(\d+|X|Y))", os.path.basename(filename))
+    if match is not None:
+        return output + "." + match.group(1)
+    return output + "." + os.path.splitext(os.path.basename(filename))[0]
+
+
+def run_chromosomes(args):
+    """
+    Run iter_infer on each of the sampledata files in args.sampledata_file
+    concurrently, each in its own process. Every run gets args.threads_per_job
+    threads (by default num_threads divided by the number of files), and runs are
+    only started while their threads and estimated memory fit within num_threads and
+    max_memory, so the machine is never oversubscribed. The largest files are
+    started first, and smaller ones fill any remaining room.
+    """
+    threads_per_job = args.threads_per_job
+    if threads_per_job is None:
+        threads_per_job = max(1, args.num_threads // len(args.sampledata_file))
+    jobs = []
+    for filename in args.sampledata_file:
+        sd = tsinfer.load(filename)
+        size = sd.num_sites * sd.num_samples
+        memory = size * args.memory_factor / 2 ** 30
+        job_args = argparse.Namespace(**vars(args))
+        job_args.sampledata_file = filename
+        job_args.output = get_chromosome_output(args.output, filename)
+        job_args.num_threads = threads_per_job
+        jobs.append((size, memory, job_args))
+    # Largest first, to minimise the time until all are finished
+    jobs.sort(key=lambda job: job[0], reverse=True)
+    running = {}
+    failed = []
+    while len(jobs) > 0 or len(running) > 0:
+        used_threads = threads_per_job * len(running)
+        used_memory = sum(memory for _, memory, _ in running.values())
+        for job in list(jobs):
+            size, memory, job_args = job
+            fits = used_threads + threads_per_job <= max(args.num_threads, threads_per_job)
+            if args.max_memory is not None and len(running) > 0:
+                fits = fits and used_memory + memory <= args.max_memory
+            if not fits:
+                continue
+            print(
+                "Starting {} with {} threads (estimated {:.1f} GB)".format(
+                    job_args.sampledata_file, threads_per_job, memory
+                )
+            )
+            process = multiprocessing.Process(target=run_chromosome, args=(job_args,))
+            process.start()
+            running[process.sentinel] = (process, memory, job_args)
+            jobs.remove(job)
+            used_threads += threads_per_job
+            used_memory += memory
+        for sentinel in multiprocessing.connection.wait(list(running.keys())):
+            process, _, job_args = running.pop(sentinel)
+            process.join()
+            if process.exitcode != 0:
+                failed.append(job_args.sampledata_file)
+            print(
+                "Finished {} with exit code {}".format(
+                    job_args.sampledata_file, process.exitcode
+                )
+            )
+    if len(failed) > 0:
+        raise ValueError("iter_infer failed for {}".format(", ".join(failed)))
+
+
 if __name__ == "__main__":
     main()
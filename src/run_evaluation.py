@@ -900,9 +900,7 @@ class Chr20SimulatedMutationAccuracy(NeutralSimulatedMutationAccuracy):
         """
         For each chromosome 20 simulation, randomly select a region to run inference on
         """
-        species = stdpopsim.get_species("HomSap")
-        genetic_map = species.get_genetic_map("HapMapII_GRCh37")
-        cm = genetic_map.get_chromosome_map("chr20")
+        cm = utility.load_genetic_map(chrom="chr20")
         pos = np.array(cm.get_positions())
         snippet = np.where(np.logical_and(pos > self.snippet[0], pos < self.snippet[1]))
         snippet_pos = pos[snippet]
@@ -995,7 +993,8 @@ class IterativeApproachNoAncients(NeutralSimulatedMutationAccuracy):
             error_inferred_ts,
             error_dated_ts,
             error_iter_infer,
-            error_dated_ts_iter
+            error_dated_ts_iter,
+            sim_fn=path_to_file + ".trees",
         )
 
         return index, row, compare_df
@@ -1304,7 +1303,7 @@ class SimulateVanillaAncient(DataGeneration):
                 output_fn=path_to_file
                 + "."
                 + str(ancient_sample_size)
-                + "ancients.iteroutput",
+                + "ancients.err.iteroutput",
                 progress=False,
                 return_trees=True,
             )
@@ -1324,6 +1323,7 @@ class SimulateVanillaAncient(DataGeneration):
                 inferred_ts_keep_times,
                 tsdate_keep_times,
                 tsdate_true_topo,
+                sim_fn=path_to_file + ".trees",
             )
             msle_master_df = pd.concat([msle_master_df, msle_compare_df], sort=False)
             pearsonr_master_df = pd.concat(
@@ -1348,6 +1348,7 @@ class SimulateVanillaAncient(DataGeneration):
                 inferred_ts_keep_times,
                 tsdate_keep_times,
                 tsdate_true_topo,
+                sim_fn=path_to_file + ".trees",
             )
             msle_master_df_err = pd.concat(
                 [msle_master_df_err, msle_compare_df_err], sort=False
@@ -2312,7 +2313,8 @@ class TsdateChr20(NeutralSimulatedMutationAccuracy):
         def get_ages(ts_dict):
             mut_ages = {}
             for name, cur_ts in ts_dict.items():
-                mut_ages[name] = utility.get_mut_pos_df(cur_ts, "Age", cur_ts.tables.nodes.time)["Age"].values
+                _, mut_ages[name] = utility.get_mut_pos_df(
+                    cur_ts, "Age", cur_ts.tables.nodes.time, as_dataframe=False)
             return mut_ages
        
         no_error = {"sim": sim, "dated": dated, "inferred_dated": inferred_dated, "mismatch_inferred_dated": mismatch_inferred_dated,
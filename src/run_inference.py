@@ -3,10 +3,10 @@ import re
 import logging
 
 import tskit
-import msprime
 import numpy as np
 import tsinfer
-import stdpopsim
+
+import utility
 
 logger = logging.getLogger(__name__)
 
@@ -122,10 +122,7 @@ def match_samples(samples, inferred_anc_ts, rho, ms_mis, precision, prefix=None,
 
 
 def physical_to_genetic(recombination_map, input_physical_positions):
-    map_pos = recombination_map.get_positions()
-    map_rates = recombination_map.get_rates()
-    map_genetic_positions = np.insert(np.cumsum(np.diff(map_pos) * map_rates[:-1]), 0, 0)
-    return np.interp(input_physical_positions, map_pos, map_genetic_positions)
+    return utility.physical_to_genetic(recombination_map, input_physical_positions)
 
 
 def get_genetic_map(filename=None, genetic_map=None):
@@ -143,16 +140,13 @@ def get_genetic_map(filename=None, genetic_map=None):
             if match is not None:
                 chr = match.group(1)
                 print(f"Using {chr} from GRCh38 for the recombination map")
-                chr_map = msprime.RecombinationMap.read_hapmap(map + chr + ".txt")
+                chr_map = utility.load_genetic_map(hapmap_fn=map + chr + ".txt")
             else:
-                chr_map = msprime.RecombinationMap.read_hapmap(map)
+                chr_map = utility.load_genetic_map(hapmap_fn=map)
         else:
             chr = match.group(1)
             print(f"Using {chr} from HapMapII_GRCh37 for the recombination map")
-            map = stdpopsim.get_species("HomSap").get_genetic_map(id="HapMapII_GRCh37")
-            if not map.is_cached():
-                map.download()
-            chr_map = map.get_chromosome_map(chr)
+            chr_map = utility.load_genetic_map(chrom=chr)
 
     return chr_map
 
@@ -1,37 +1,257 @@
+"""
+Mean pairwise TMRCAs between populations in a dated tree sequence. Run as a script,
+the genome is split into equal windows which are processed by a pool of workers.
+"""
+import argparse
 import multiprocessing
 import tskit
 import json
 import numpy as np
 import pandas as pd
-import itertools
+import scipy.sparse
 from tqdm import tqdm
 import collections
 
-ts = tskit.load("merged_hgdp_1kg_sgdp_high_cov_ancients_chr20.dated.binned.historic.trees")
-
-node_ages = ts.tables.nodes.time[:]
-deleted_trees = [tree.index for tree in ts.trees() if tree.parent(0) == -1]  
-
-metadata = ts.tables.nodes.metadata[:]
-metadata_offset = ts.tables.nodes.metadata_offset[:]
-for index, met in enumerate(tskit.unpack_bytes(metadata, metadata_offset)):
-    if index not in ts.samples():
-        try:
-            node_ages[index] = json.loads(met.decode())["mn"]
-        except json.decoder.JSONDecodeError:
-            raise ValueError(
-                    "Tree Sequence must be dated to use unconstrained=True")
-pop_nodes = ts.tables.nodes.population[ts.samples()]
-pop_nodes = [np.where(pop_nodes == pop.id)[0] for pop in ts.populations()]
-rand_nodes = list()
-for nodes in pop_nodes:
-    if len(nodes) > 20:
-        rand_nodes.append(np.random.choice(nodes, 20, replace=False))
-    else:
-        rand_nodes.append(nodes)
-
-
-def get_pairwise_tmrca_pops(ts):
+import utility
+
+
+def sample_population_nodes(ts, num_nodes=20, seed=None):
+    """
+    Return a list with up to num_nodes randomly chosen sample nodes from each
+    population.
+    """
+    rng = np.random.RandomState(seed)
+    pop_nodes = ts.tables.nodes.population[ts.samples()]
+    pop_nodes = [np.where(pop_nodes == pop.id)[0] for pop in ts.populations()]
+    rand_nodes = list()
+    for nodes in pop_nodes:
+        if len(nodes) > num_nodes:
+            rand_nodes.append(rng.choice(nodes, num_nodes, replace=False))
+        else:
+            rand_nodes.append(nodes)
+    return rand_nodes
+
+
+def get_tree_parents(ts, left=0, right=None):
+    """
+    Yield (tree_left, tree_right, parent) for each tree overlapping [left, right),
+    where parent is a node parent array updated in place by inserting and removing
+    the edges at each breakpoint. The first tree is found by seeking, so iteration can
+    start anywhere in the genome.
+    """
+    if right is None:
+        right = ts.sequence_length
+    tables = ts.tables
+    edges = tables.edges
+    breakpoints = ts.breakpoints(as_array=True)
+    in_order = tables.indexes.edge_insertion_order
+    out_order = tables.indexes.edge_removal_order
+    sorted_left = edges.left[in_order]
+    sorted_right = edges.right[out_order]
+    tree_index = np.searchsorted(breakpoints, left, side="right") - 1
+    tree_left = breakpoints[tree_index]
+    parent = np.full(ts.num_nodes, tskit.NULL, dtype=np.int32)
+    present = np.logical_and(edges.left <= tree_left, edges.right > tree_left)
+    parent[edges.child[present]] = edges.parent[present]
+    while tree_left < right:
+        tree_right = breakpoints[tree_index + 1]
+        yield tree_left, tree_right, parent
+        if tree_right >= ts.sequence_length:
+            break
+        removed = out_order[
+            np.searchsorted(sorted_right, tree_right, side="left"):
+            np.searchsorted(sorted_right, tree_right, side="right")]
+        parent[edges.child[removed]] = tskit.NULL
+        inserted = in_order[
+            np.searchsorted(sorted_left, tree_right, side="left"):
+            np.searchsorted(sorted_left, tree_right, side="right")]
+        parent[edges.child[inserted]] = edges.parent[inserted]
+        tree_index += 1
+        tree_left = tree_right
+
+
+def get_node_values(node_times, geometric=True):
+    """
+    Return the value averaged over pairs for each node: log time for geometric means
+    (0 for nodes at time <= 0) or the time itself for arithmetic means.
+    """
+    node_times = np.asarray(node_times, dtype=np.float64)
+    if not geometric:
+        return node_times
+    values = np.zeros_like(node_times)
+    positive = node_times > 0
+    values[positive] = np.log(node_times[positive])
+    return values
+
+
+def accumulate_tmrcas(ts, sample_sets, node_values, left=0, right=None):
+    """
+    Return a P x P matrix of span weighted sums over the trees in [left, right) of the
+    value of the MRCA, summed over all ordered pairs of nodes (including a node paired
+    with itself) from sample_sets[i] and sample_sets[j], together with the total span.
+    Trees where node 0 has no parent are skipped.
+
+    With C[v, i] the number of nodes of sample_sets[i] below (or at) node v and
+    w[v] the value of v minus the value of its parent (or the value of v for roots),
+    the sum over pairs of the MRCA value telescopes to C.T @ diag(w) @ C, so each tree
+    costs one climb from the sampled nodes rather than one MRCA query per pair.
+    """
+    if right is None:
+        right = ts.sequence_length
+    num_sets = len(sample_sets)
+    sample_nodes = np.concatenate(sample_sets).astype(np.int64)
+    sample_pops = np.repeat(
+        np.arange(num_sets), [len(nodes) for nodes in sample_sets])
+    sums = np.zeros((num_sets, num_sets))
+    total_span = 0
+    for tree_left, tree_right, parent in get_tree_parents(ts, left, right):
+        if parent[0] == tskit.NULL:
+            continue
+        span = min(tree_right, right) - max(tree_left, left)
+        # Climb from the sampled nodes, merging (node, population) paths as they meet
+        keys = sample_nodes * num_sets + sample_pops
+        counts = np.ones(len(keys))
+        all_keys = []
+        all_counts = []
+        while len(keys) > 0:
+            keys, inverse = np.unique(keys, return_inverse=True)
+            counts = np.bincount(inverse, weights=counts)
+            all_keys.append(keys)
+            all_counts.append(counts)
+            up = parent[keys // num_sets]
+            has_parent = up != tskit.NULL
+            keys = up[has_parent].astype(np.int64) * num_sets + keys[has_parent] % num_sets
+            counts = counts[has_parent]
+        keys, inverse = np.unique(np.concatenate(all_keys), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate(all_counts))
+        nodes, rows = np.unique(keys // num_sets, return_inverse=True)
+        node_parents = parent[nodes]
+        weights = node_values[nodes] - np.where(
+            node_parents == tskit.NULL, 0, node_values[node_parents])
+        below = scipy.sparse.csr_matrix(
+            (counts, (rows, keys % num_sets)), shape=(len(nodes), num_sets))
+        sums += span * (below.T @ (scipy.sparse.diags(weights) @ below)).toarray()
+        total_span += span
+    return sums, total_span
+
+
+def finalise_tmrcas(sums, total_span, sample_sets, node_values, geometric=True):
+    """
+    Turn the output of accumulate_tmrcas into the mean MRCA time over distinct pairs
+    of nodes for each pair of sample sets, NaN where there are no such pairs.
+    """
+    sizes = np.array([len(nodes) for nodes in sample_sets], dtype=np.float64)
+    self_values = np.array([np.sum(node_values[nodes]) for nodes in sample_sets])
+    sums = sums.copy()
+    # Remove each node paired with itself; distinct pairs are counted in both orders
+    sums[np.diag_indices_from(sums)] -= total_span * self_values
+    num_pairs = np.outer(sizes, sizes) - np.diag(sizes)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = sums / (total_span * num_pairs)
+    if geometric:
+        means = np.exp(means)
+    return means
+
+
+def get_tmrca_matrix(ts, sample_sets, node_times, geometric=True):
+    """
+    Return the span weighted mean (geometric by default) TMRCA between pairs of nodes
+    from each pair of sample sets, from a single pass over the trees.
+    """
+    node_values = get_node_values(node_times, geometric=geometric)
+    sums, total_span = accumulate_tmrcas(ts, sample_sets, node_values)
+    return finalise_tmrcas(sums, total_span, sample_sets, node_values, geometric=geometric)
+
+
+# Per-worker state, set by _init_window_worker
+_window_ts = None
+_window_sample_sets = None
+_window_node_values = None
+
+
+def _init_window_worker(ts_fn, sample_sets, shared_node_values):
+    global _window_ts, _window_sample_sets, _window_node_values
+    _window_ts = tskit.load(ts_fn)
+    _window_sample_sets = sample_sets
+    _window_node_values = np.frombuffer(shared_node_values, dtype=np.float64)
+
+
+def _window_worker(window):
+    left, right = window
+    return accumulate_tmrcas(
+        _window_ts, _window_sample_sets, _window_node_values, left, right)
+
+
+def get_tmrca_matrix_parallel(
+        ts_fn, sample_sets, node_times, geometric=True, num_workers=1,
+        num_windows=None, windows=None, windows_fn=None):
+    """
+    As get_tmrca_matrix, splitting the genome into num_windows equal windows (by
+    default four per worker) which workers process by seeking to their start. Node
+    values are held in shared memory rather than copied to each worker.
+
+    If windows, a list of (left, right) intervals, is given, a TMRCA matrix for each
+    of them is computed in the same traversal and written to windows_fn as a .npy
+    memory mapped array of shape (len(windows), P, P) as soon as it is complete.
+    Windows may overlap and need not cover the genome.
+    """
+    node_values = get_node_values(node_times, geometric=geometric)
+    ts = tskit.load(ts_fn)
+    if num_windows is None:
+        num_windows = 4 * num_workers
+    num_sets = len(sample_sets)
+    breaks = np.linspace(0, ts.sequence_length, num_windows + 1)
+    if windows is not None:
+        windows = np.clip(
+            np.asarray(windows, dtype=np.float64).reshape(-1, 2), 0, ts.sequence_length)
+        breaks = np.unique(np.concatenate([breaks, windows.ravel()]))
+        # Every window is a union of the segments between consecutive breaks
+        segment_windows = [[] for _ in range(len(breaks) - 1)]
+        remaining = np.zeros(len(windows), dtype=np.int64)
+        for j, (left, right) in enumerate(windows):
+            first, last = np.searchsorted(breaks, [left, right])
+            for k in range(first, last):
+                segment_windows[k].append(j)
+            remaining[j] = last - first
+        window_tmrcas = np.lib.format.open_memmap(
+            windows_fn, mode="w+", dtype=np.float64,
+            shape=(len(windows), num_sets, num_sets))
+        window_tmrcas[:] = np.nan
+        pending = {}
+    segments = list(zip(breaks[:-1], breaks[1:]))
+    shared_node_values = multiprocessing.RawArray("d", len(node_values))
+    np.frombuffer(shared_node_values, dtype=np.float64)[:] = node_values
+    sums = np.zeros((num_sets, num_sets))
+    total_span = 0
+    with multiprocessing.Pool(
+            processes=num_workers, initializer=_init_window_worker,
+            initargs=(ts_fn, sample_sets, shared_node_values)) as pool:
+        results = pool.imap(_window_worker, segments)
+        for k, (segment_sums, segment_span) in enumerate(
+                tqdm(results, total=len(segments))):
+            sums += segment_sums
+            total_span += segment_span
+            if windows is None:
+                continue
+            for j in segment_windows[k]:
+                window_sums, window_span = pending.get(j, (0, 0))
+                window_sums = window_sums + segment_sums
+                window_span = window_span + segment_span
+                remaining[j] -= 1
+                if remaining[j] > 0:
+                    pending[j] = (window_sums, window_span)
+                    continue
+                pending.pop(j, None)
+                window_tmrcas[j] = finalise_tmrcas(
+                    window_sums, window_span, sample_sets, node_values,
+                    geometric=geometric)
+                window_tmrcas.flush()
+    if windows is not None:
+        del window_tmrcas
+    return finalise_tmrcas(sums, total_span, sample_sets, node_values, geometric=geometric)
+
+
+def get_pop_names(ts):
     pop_names = [json.loads(pop.metadata)["name"] for pop in ts.populations()]
     if input == "1kg_sgdp_hgdp":
         pop_name_suffixes = pop_names[0:26]
@@ -40,37 +260,66 @@ def get_pairwise_tmrca_pops(ts):
         for pop in pop_names[156:]:
             pop_name_suffixes.append(pop + "_HGDP")
         pop_names = pop_name_suffixes
-    tmrca_df = pd.DataFrame(columns=pop_names, index=pop_names)
-    pop_rows = list()
-    combos = list(itertools.combinations_with_replacement(np.arange(0, ts.num_populations),2))
-    weights = np.array([tree.span for tree in ts.trees() if tree.index not in deleted_trees])
-    with multiprocessing.Pool(processes=10) as pool: 
-        for avg_tmrca, combo in tqdm(pool.imap_unordered(get_avg_tmrca, combos), total=len(combos)):
-            tmrca_df.loc[pop_names[combo[0]], pop_names[combo[1]]] = np.exp(np.average(np.log(avg_tmrca), weights=weights))
-    return tmrca_df
-
-def get_avg_tmrca(combo):
-    avg_tmrca = []
-    pop_0 = combo[0]
-    pop_1 = combo[1]
-    pop_0_nodes = rand_nodes[pop_0]
-    if pop_0 != pop_1:
-        pop_1_nodes = rand_nodes[pop_1]
-        node_combos = [(x, y) for x in pop_0_nodes for y in pop_1_nodes]
-    elif pop_0 == pop_1:
-        node_combos = list(itertools.combinations(pop_0_nodes, 2))
-    avg_tmrca = np.zeros((ts.num_trees - len(deleted_trees), len(node_combos)))
-
-    t_index = 0
-    for tree in ts.trees(): 
-        if tree.index not in deleted_trees:
-            tree_tmrcas = []
-            for index, (node_0, node_1) in enumerate(node_combos):
-                avg_tmrca[t_index, index] = node_ages[tree.mrca(node_0, node_1)]
-            t_index += 1
-    avg_tmrca = np.exp(np.mean(np.log(avg_tmrca), axis=1))
-    return avg_tmrca, combo
-
-
-df = get_pairwise_tmrca_pops(ts)
-df.to_csv("all-data/merged_hgdp_1kg_sgdp_high_cov_ancients_chr20.dated.binned.historic.tmrcas")
+    return pop_names
+
+
+def get_pairwise_tmrca_pops(
+        ts_fn, num_nodes=20, seed=None, num_workers=1, num_windows=None,
+        windows=None, windows_fn=None):
+    ts = tskit.load(ts_fn)
+    node_ages = utility.get_unconstrained_node_times(ts, trees_fn=ts_fn)
+    rand_nodes = sample_population_nodes(ts, num_nodes=num_nodes, seed=seed)
+    pop_names = get_pop_names(ts)
+    tmrcas = get_tmrca_matrix_parallel(
+        ts_fn, rand_nodes, node_ages, num_workers=num_workers, num_windows=num_windows,
+        windows=windows, windows_fn=windows_fn)
+    return pd.DataFrame(tmrcas, columns=pop_names, index=pop_names)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compute mean pairwise TMRCAs between the populations of a tree sequence.")
+    parser.add_argument(
+        "--input", type=str,
+        default="merged_hgdp_1kg_sgdp_high_cov_ancients_chr20.dated.binned.historic.trees",
+        help="Dated tree sequence")
+    parser.add_argument(
+        "--output", type=str,
+        default="all-data/merged_hgdp_1kg_sgdp_high_cov_ancients_chr20.dated.binned.historic.tmrcas",
+        help="Output CSV of the population by population TMRCA matrix")
+    parser.add_argument(
+        "--num-workers", type=int, default=10, help="Number of worker processes")
+    parser.add_argument(
+        "--num-windows", type=int, default=None,
+        help="Number of equal genomic windows (default four per worker)")
+    parser.add_argument(
+        "--num-nodes", type=int, default=20,
+        help="Number of sample nodes drawn from each population")
+    parser.add_argument(
+        "--seed", type=int, default=None, help="Seed for the choice of sample nodes")
+    parser.add_argument(
+        "--windows", type=str, default=None,
+        help="Whitespace separated file of left and right coordinates, one window per "
+        "line, for which to also output TMRCA matrices")
+    parser.add_argument(
+        "--windows-output", type=str, default=None,
+        help="Output .npy file of per window TMRCA matrices "
+        "(default: output with a .windows.npy suffix)")
+    args = parser.parse_args()
+
+    windows = None
+    windows_fn = None
+    if args.windows is not None:
+        windows = np.loadtxt(args.windows, ndmin=2)
+        windows_fn = args.windows_output
+        if windows_fn is None:
+            windows_fn = args.output + ".windows.npy"
+    df = get_pairwise_tmrca_pops(
+        args.input, num_nodes=args.num_nodes, seed=args.seed,
+        num_workers=args.num_workers, num_windows=args.num_windows,
+        windows=windows, windows_fn=windows_fn)
+    df.to_csv(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,762 @@
 """
 Useful functions used in multiple scripts.
 """
+import collections
+import hashlib
+import json
+import os
 
 import numpy as np
 import pandas as pd
 
 import tskit
+import tsdate
+
+
+def get_mut_parents(ts, tables=None):
+    """
+    Return the parent of each mutation's node at the mutation's position, or
+    tskit.NULL if the mutation is above a root. This is done in a single pass over
+    the edge table: edges are sorted by child and left coordinate and each mutation
+    is looked up by its node and site position, so no trees are built.
+    """
+    if tables is None:
+        tables = ts.tables
+    edges = tables.edges
+    mutations = tables.mutations
+    parents = np.full(len(mutations), tskit.NULL, dtype=np.int32)
+    if len(edges) == 0 or len(mutations) == 0:
+        return parents
+    mut_pos = tables.sites.position[mutations.site]
+    # Replace coordinates by their rank among the edge left coordinates so that
+    # (child, left) packs exactly into a single int64 key
+    breakpoints = np.unique(edges.left)
+    num_breakpoints = len(breakpoints)
+    edge_key = edges.child.astype(np.int64) * num_breakpoints + np.searchsorted(
+        breakpoints, edges.left
+    )
+    order = np.argsort(edge_key, kind="mergesort")
+    edge_key = edge_key[order]
+    mut_key = mutations.node.astype(np.int64) * num_breakpoints + (
+        np.searchsorted(breakpoints, mut_pos, side="right") - 1
+    )
+    # The only edge which can lie above a mutation is the last edge of the mutation's
+    # node which starts at or before the mutation's position
+    index = np.searchsorted(edge_key, mut_key, side="right") - 1
+    found = index >= 0
+    index[~found] = 0
+    edge_index = order[index]
+    found = np.logical_and(found, edges.child[edge_index] == mutations.node)
+    found = np.logical_and(found, edges.right[edge_index] > mut_pos)
+    parents[found] = edges.parent[edge_index[found]]
+    return parents
+
+
+def get_oldest_mutations(mut_sites, mut_ages, num_sites, mask=None):
+    """
+    Return the id of the oldest mutation at each site, or -1 for sites without
+    mutations. Ties are broken in favour of the mutation with the lowest id. If mask
+    is given, only mutations where it is True are considered.
+    """
+    oldest = np.full(num_sites, -1, dtype=np.int64)
+    mut_ids = np.arange(len(mut_sites))
+    if mask is not None:
+        mut_ids = mut_ids[mask]
+    if len(mut_ids) == 0:
+        return oldest
+    # lexsort is stable, so ties keep mutation order
+    order = mut_ids[np.lexsort((-mut_ages[mut_ids], mut_sites[mut_ids]))]
+    sorted_sites = mut_sites[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_sites[1:] != sorted_sites[:-1]
+    oldest[sorted_sites[first]] = order[first]
+    return oldest
+
+
+def get_back_mutations(tables):
+    """
+    Return a boolean array marking the mutations whose derived state is the
+    ancestral state of their site.
+    """
+    ancestral_states = np.array(
+        tskit.unpack_strings(
+            tables.sites.ancestral_state, tables.sites.ancestral_state_offset
+        )
+    )
+    derived_states = np.array(
+        tskit.unpack_strings(
+            tables.mutations.derived_state, tables.mutations.derived_state_offset
+        )
+    )
+    if len(derived_states) == 0:
+        return np.zeros(0, dtype=bool)
+    return derived_states == ancestral_states[tables.mutations.site]
+
+
+def get_mut_times(ts, dates, geometric=True, tables=None):
+    """
+    Return the age, upper bound (parent age) and parent node of every mutation, in
+    mutation table order. The age is the geometric or arithmetic mean of the node and
+    parent ages.
+    """
+    if tables is None:
+        tables = ts.tables
+    parents = get_mut_parents(ts, tables=tables)
+    # As with tree.parent(), a mutation above a root has a parent of tskit.NULL, which
+    # indexes the last (oldest) node
+    mut_upper_bounds = dates[parents]
+    node_ages = dates[tables.mutations.node]
+    if geometric:
+        mut_ages = np.sqrt(node_ages * mut_upper_bounds)
+    else:
+        mut_ages = (node_ages + mut_upper_bounds) / 2
+    return mut_ages, mut_upper_bounds, parents
+
+
+def get_site_ages(ts, dates, geometric=True, exclude_root=False, tables=None):
+    """
+    Return arrays of the age of the oldest mutation at each site, that mutation's
+    upper bound and its id. Sites without mutations have an age of -inf, an upper
+    bound of NaN and a mutation id of -1. If exclude_root is True, mutations directly
+    below the oldest node are ignored.
+    """
+    if tables is None:
+        tables = ts.tables
+    mut_ages, mut_upper_bounds, parents = get_mut_times(
+        ts, dates, geometric=geometric, tables=tables
+    )
+    if exclude_root:
+        mut_ages = np.where(parents == ts.num_nodes - 1, -np.inf, mut_ages)
+    oldest_mut_ids = get_oldest_mutations(
+        tables.mutations.site, mut_ages, ts.num_sites
+    )
+    has_mut = oldest_mut_ids != -1
+    site_ages = np.full(ts.num_sites, -np.inf)
+    site_ages[has_mut] = mut_ages[oldest_mut_ids[has_mut]]
+    site_upper_bounds = np.full(ts.num_sites, np.nan)
+    dated = site_ages != -np.inf
+    site_upper_bounds[dated] = mut_upper_bounds[oldest_mut_ids[dated]]
+    return site_ages, site_upper_bounds, oldest_mut_ids
 
 
 def get_mut_ages(ts, dates):
-    mut_ages = list()
-    mut_upper_bounds = list()
-    for tree in ts.trees():
-        for site in tree.sites():
-            for mut in site.mutations:
-                parent_age = dates[tree.parent(mut.node)]
-                mut_upper_bounds.append(parent_age)
-                mut_ages.append((dates[mut.node] + parent_age) / 2)
-    return np.array(mut_ages), np.array(mut_upper_bounds)
+    mut_ages, mut_upper_bounds, _ = get_mut_times(ts, dates, geometric=False)
+    return mut_ages, mut_upper_bounds
 
 
 def get_mut_ages_dict(ts, dates, exclude_root=False):
-    site_ages = dict()
-    for tree in ts.trees():
-        for site in tree.sites():
-            site_ages[site.position] = -np.inf
-            for mut in site.mutations:
-                parent_node = tree.parent(mut.node)
-                if exclude_root and parent_node == ts.num_nodes - 1:
-                    continue
-                else:
-                    parent_age = dates[parent_node]
-                    mut_age = np.sqrt(dates[mut.node] * parent_age)
-                    if site_ages[site.position] < mut_age:
-                        site_ages[site.position] = mut_age
-    return site_ages 
-
-def get_mut_pos_df(ts, name, node_dates, exclude_root=False):
-    mut_dict = get_mut_ages_dict(ts, node_dates, exclude_root=exclude_root) 
-    mut_df = pd.DataFrame.from_dict(mut_dict, orient="index", columns=[name])
-    mut_df.index = (np.round(mut_df.index)).astype(int)
-    sort_dates = mut_df.sort_values(by=[name], ascending=False, kind="mergesort")
-    mut_df = sort_dates.groupby(sort_dates.index).first()
-#    mut_df = mut_df.loc[~mut_df.index.duplicated()]
-    return mut_df
+    site_ages, _, _ = get_site_ages(ts, dates, exclude_root=exclude_root)
+    return dict(zip(ts.tables.sites.position, site_ages))
+
+
+def ts_content_hash(ts, tables=None, metadata=False):
+    """
+    Return a hex digest of the node times, topology, sites and mutations of a tree
+    sequence, optionally also including the node metadata.
+    """
+    if tables is None:
+        tables = ts.tables
+    columns = [
+        tables.nodes.time,
+        tables.nodes.flags,
+        tables.edges.left,
+        tables.edges.right,
+        tables.edges.parent,
+        tables.edges.child,
+        tables.sites.position,
+        tables.mutations.site,
+        tables.mutations.node,
+    ]
+    if metadata:
+        columns += [tables.nodes.metadata, tables.nodes.metadata_offset]
+    digest = hashlib.sha1()
+    for column in columns:
+        digest.update(np.ascontiguousarray(column))
+    return digest.hexdigest()
+
+
+class SiteAgeCache:
+    """
+    Least recently used in-memory cache of per-site age arrays, keyed by the content
+    of a tree sequence and the parameters used to compute the ages. If the path of
+    the .trees file is given, entries are also saved as .npz files next to it and
+    reloaded from there.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+
+    def npz_path(self, key, trees_fn):
+        if trees_fn.endswith(".trees"):
+            trees_fn = trees_fn[: -len(".trees")]
+        return "{}.{}.site_ages.npz".format(trees_fn, key[:16])
+
+    def get(self, key, compute, trees_fn=None):
+        """
+        Return the arrays stored under key, calling compute() to create them on a
+        cache miss. Returned arrays are read-only as they are shared between callers.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        npz_fn = None if trees_fn is None else self.npz_path(key, trees_fn)
+        if npz_fn is not None and os.path.exists(npz_fn):
+            with np.load(npz_fn) as data:
+                arrays = tuple(data["arr_{}".format(j)] for j in range(len(data.files)))
+        else:
+            arrays = tuple(compute())
+            if npz_fn is not None:
+                np.savez(npz_fn, *arrays)
+        for array in arrays:
+            array.flags.writeable = False
+        self.entries[key] = arrays
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return arrays
+
+    def clear(self):
+        self.entries.clear()
+
+
+site_age_cache = SiteAgeCache()
+
+
+def get_site_age_table(
+    ts, node_dates, exclude_root=False, trees_fn=None, cache=site_age_cache
+):
+    """
+    Return an int64 array of rounded site positions and a float64 array of the age of
+    the oldest mutation at each position. Where several sites round to the same
+    position, the oldest age is kept. Results are cached in cache; if it is None,
+    they are computed directly without hashing the tree sequence.
+    """
+    tables = ts.tables
+    node_dates = np.ascontiguousarray(node_dates, dtype=np.float64)
+
+    def compute():
+        site_ages, _, _ = get_site_ages(
+            ts, node_dates, exclude_root=exclude_root, tables=tables
+        )
+        positions = np.round(tables.sites.position).astype(np.int64)
+        if len(positions) == 0:
+            return positions, site_ages
+        # Sites are sorted by position, so equal rounded positions are contiguous
+        starts = np.flatnonzero(np.r_[True, positions[1:] != positions[:-1]])
+        return positions[starts], np.fmax.reduceat(site_ages, starts)
+
+    if cache is None:
+        return compute()
+    digest = hashlib.sha1(ts_content_hash(ts, tables=tables).encode())
+    digest.update(node_dates)
+    digest.update("site_age_table exclude_root={}".format(exclude_root).encode())
+    return cache.get(digest.hexdigest(), compute, trees_fn=trees_fn)
+
+
+def get_tsdate_site_times(ts, unconstrained=True, trees_fn=None):
+    """
+    Cached version of tsdate.get_site_times.
+    """
+    digest = hashlib.sha1(ts_content_hash(ts, metadata=unconstrained).encode())
+    digest.update("tsdate_site_times unconstrained={}".format(unconstrained).encode())
+
+    def compute():
+        return (tsdate.get_site_times(ts, unconstrained=unconstrained),)
+
+    return site_age_cache.get(digest.hexdigest(), compute, trees_fn=trees_fn)[0]
+
+
+def decode_metadata_field(metadata, metadata_offset, field, mask):
+    """
+    Return the value of field in the JSON metadata of every row selected by the
+    boolean mask, in row order. The selected metadata are joined into a single JSON
+    array in one vectorised pass, so json.loads is only called once.
+    """
+    # Offsets are unsigned in tskit tables, which np.repeat and np.insert reject
+    offsets = np.asarray(metadata_offset, dtype=np.int64)
+    lengths = np.diff(offsets)
+    if np.any(lengths[mask] == 0):
+        raise ValueError("Metadata is missing for some of the selected rows")
+    if not np.any(mask):
+        return np.zeros(0)
+    buff = np.asarray(metadata, dtype=np.int8)[np.repeat(mask, lengths)]
+    # Put a comma after every record except the last
+    buff = np.insert(buff, np.cumsum(lengths[mask])[:-1], ord(","))
+    try:
+        records = json.loads(b"[" + buff.tobytes() + b"]")
+    except json.decoder.JSONDecodeError:
+        raise ValueError("Could not decode metadata as JSON")
+    return np.array([record[field] for record in records], dtype=np.float64)
+
+
+def replace_metadata(metadata, metadata_offset, ids, values):
+    """
+    Return new metadata and metadata_offset columns in which the metadata of the
+    (distinct) rows ids is replaced by the corresponding bytes in values. The other
+    rows are moved with array operations rather than unpacked one by one.
+    """
+    metadata = np.asarray(metadata, dtype=np.int8)
+    offset = np.asarray(metadata_offset, dtype=np.int64)
+    ids = np.asarray(ids, dtype=np.int64)
+    lengths = np.diff(offset)
+    new_lengths = lengths.copy()
+    new_lengths[ids] = [len(value) for value in values]
+    new_offset = np.zeros(len(offset), dtype=np.int64)
+    new_offset[1:] = np.cumsum(new_lengths)
+    new_metadata = np.zeros(new_offset[-1], dtype=np.int8)
+    # Shift the bytes of the rows we keep to their new starts
+    keep = np.ones(len(lengths), dtype=bool)
+    keep[ids] = False
+    keep_bytes = np.repeat(keep, lengths)
+    shift = np.repeat(new_offset[:-1] - offset[:-1], lengths)
+    old_pos = np.arange(offset[-1])
+    new_metadata[old_pos[keep_bytes] + shift[keep_bytes]] = metadata[: offset[-1]][
+        keep_bytes
+    ]
+    if len(ids) > 0:
+        value_bytes = np.frombuffer(b"".join(values), dtype=np.int8)
+        value_lengths = new_lengths[ids]
+        value_starts = np.cumsum(value_lengths) - value_lengths
+        within = np.arange(len(value_bytes)) - np.repeat(value_starts, value_lengths)
+        new_metadata[np.repeat(new_offset[ids], value_lengths) + within] = value_bytes
+    return new_metadata, new_offset.astype(np.asarray(metadata_offset).dtype)
+
+
+def get_unconstrained_node_times(ts, trees_fn=None):
+    """
+    Return the node times of a dated tree sequence with the times of non-sample nodes
+    replaced by the unconstrained posterior means ("mn") stored by tsdate in the node
+    metadata. If trees_fn is the path ts was loaded from, the decoded times are
+    cached in an .mn.npz side-car file, which is ignored if the metadata changes.
+    """
+    tables = ts.tables
+    nodes = tables.nodes
+    non_samples = (nodes.flags & tskit.NODE_IS_SAMPLE) == 0
+    digest = hashlib.sha1(np.ascontiguousarray(nodes.metadata))
+    digest.update(np.ascontiguousarray(nodes.metadata_offset))
+    digest.update(np.ascontiguousarray(non_samples))
+    key = digest.hexdigest()
+    cache_fn = None
+    if trees_fn is not None:
+        if trees_fn.endswith(".trees"):
+            trees_fn = trees_fn[: -len(".trees")]
+        cache_fn = trees_fn + ".mn.npz"
+        if os.path.exists(cache_fn):
+            with np.load(cache_fn) as data:
+                if str(data["key"]) == key:
+                    return data["time"]
+    times = nodes.time.copy()
+    try:
+        times[non_samples] = decode_metadata_field(
+            nodes.metadata, nodes.metadata_offset, "mn", non_samples
+        )
+    except (ValueError, KeyError):
+        raise ValueError("Tree Sequence must be dated to use unconstrained=True")
+    if cache_fn is not None:
+        np.savez(cache_fn, key=key, time=times)
+    return times
+
+
+def get_mut_pos_df(ts, name, node_dates, exclude_root=False, as_dataframe=True,
+                   trees_fn=None, cache=site_age_cache):
+    """
+    Return the age of the oldest mutation at each (rounded) site position as a
+    DataFrame indexed by position with a single column called name. If as_dataframe
+    is False, return the (read-only) position and age arrays instead. If trees_fn is
+    the path ts was loaded from, the ages are also cached on disk next to it. Pass
+    cache=None for one-off calls, which then skip hashing the tree sequence.
+    """
+    positions, ages = get_site_age_table(
+        ts, node_dates, exclude_root=exclude_root, trees_fn=trees_fn, cache=cache
+    )
+    if not as_dataframe:
+        return positions, ages
+    return pd.DataFrame({name: ages.copy()}, index=positions.copy())
+
+
+# Codes used to pack single nucleotide alleles into int64 join keys. Code 0 marks an
+# allele which cannot be encoded.
+ALLELE_CODES = {"A": 1, "C": 2, "G": 3, "T": 4}
+
+
+def encode_alleles(alleles):
+    """
+    Return an int64 array of ALLELE_CODES for an array of allele strings, with 0 for
+    any allele that is not a single nucleotide.
+    """
+    codes, uniques = pd.factorize(np.asarray(alleles, dtype=object))
+    lookup = np.array(
+        [ALLELE_CODES.get(allele, 0) for allele in uniques] + [0], dtype=np.int64
+    )
+    # Missing values are factorized as -1, which picks the trailing 0
+    return lookup[codes]
+
+
+def encode_allele_keys(positions, ancestral, derived):
+    """
+    Pack the position, ancestral and derived allele of each row into a single int64
+    key, so tables can be joined on integers rather than on Python strings. Rows with
+    an allele that is not a single nucleotide get a key of -1.
+    """
+    ancestral = encode_alleles(ancestral)
+    derived = encode_alleles(derived)
+    keys = (np.round(np.asarray(positions, dtype=np.float64)).astype(np.int64) << 6) | (
+        ancestral << 3
+    ) | derived
+    keys[np.logical_or(ancestral == 0, derived == 0)] = -1
+    return keys
+
+
+def iter_sorted_chunks(df, key, chunksize=1000000):
+    """
+    Sort a DataFrame by the column key and yield it in chunks of chunksize rows. An
+    empty DataFrame is yielded once, so its columns still reach sorted_merge_join.
+    """
+    df = df.sort_values(by=key, kind="mergesort")
+    if len(df) == 0:
+        yield df
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start : start + chunksize]
+
+
+def sorted_merge_join(
+    left_chunks, right_chunks, key="key", how="inner", right_columns=()
+):
+    """
+    Merge-join two streams of DataFrame chunks which are each sorted by the int64
+    column key, yielding joined chunks in key order. Only the right rows overlapping
+    the current left chunk are held in memory, so the streams can come from chunked
+    readers of pre-sorted files. Right rows with a negative key never match. how is
+    "inner" or "left", as in pd.merge. If the right stream yields no chunks, joined
+    rows get right_columns filled with NaN. At least one (possibly empty) chunk is
+    yielded whenever the left stream yields one.
+    """
+    right_chunks = iter(right_chunks)
+    # Stands in for the right rows until the first right chunk is read
+    buffer = pd.DataFrame({key: np.zeros(0, dtype=np.int64)}).reindex(
+        columns=[key] + [column for column in right_columns if column != key]
+    )
+    read_right = False
+    exhausted = False
+
+    def read_right_chunk():
+        nonlocal buffer, read_right, exhausted
+        try:
+            chunk = next(right_chunks)
+        except StopIteration:
+            exhausted = True
+            return
+        chunk = chunk[chunk[key] >= 0]
+        buffer = pd.concat([buffer, chunk]) if read_right else chunk
+        read_right = True
+
+    empty_left = None
+    num_yielded = 0
+    for left in left_chunks:
+        if len(left) == 0:
+            empty_left = left
+            continue
+        max_key = left[key].iloc[-1]
+        # Read until the buffer holds every right row with a key <= max_key
+        while not exhausted and (len(buffer) == 0 or buffer[key].iloc[-1] <= max_key):
+            read_right_chunk()
+        yield pd.merge(left, buffer[buffer[key] <= max_key], on=key, how=how)
+        num_yielded += 1
+        # The next left chunk may start with max_key again
+        buffer = buffer[buffer[key] >= max_key]
+    if num_yielded == 0 and empty_left is not None:
+        # Empty input still gives the columns of the join
+        if not read_right and not exhausted:
+            read_right_chunk()
+        yield pd.merge(empty_left, buffer.iloc[:0], on=key, how=how)
+
+
+def genotype_chunks(sample_data, sample_ids=None, site_mask=None):
+    """
+    Yield (start, genotypes) for successive blocks of sites in a SampleData file,
+    following the zarr chunking of sites_genotypes so only one chunk of sites is
+    decompressed at a time. If sample_ids is given only those columns are read. If
+    the boolean site_mask is given, blocks without any selected site are skipped
+    without being read.
+    """
+    genotypes = sample_data.sites_genotypes
+    chunk_size = genotypes.chunks[0]
+    for start in range(0, genotypes.shape[0], chunk_size):
+        stop = min(start + chunk_size, genotypes.shape[0])
+        if site_mask is not None and not np.any(site_mask[start:stop]):
+            continue
+        if sample_ids is None:
+            yield start, genotypes[start:stop]
+        else:
+            yield start, genotypes.oindex[start:stop, sample_ids]
+
+
+def file_signature(filename):
+    """
+    Return the absolute path, size and modification time of a file, which together
+    stand in for its contents when deciding whether a cached artifact is stale. Size
+    and modification time are None if the file does not exist.
+    """
+    if not os.path.exists(filename):
+        return [os.path.abspath(filename), None, None]
+    stat = os.stat(filename)
+    return [os.path.abspath(filename), stat.st_size, stat.st_mtime_ns]
+
+
+def save_columns(filename, columns, info=None):
+    """
+    Save a dict of 1D arrays to an .npz file, one array per column. Object columns
+    are stored as fixed width strings plus a mask of their null values, and are
+    restored as objects (with NaN where they were null) by load_columns. info is any
+    JSON serialisable description of the columns, read back by load_column_info.
+    """
+    arrays = {}
+    object_columns = []
+    for j, (name, values) in enumerate(columns.items()):
+        values = np.asarray(values)
+        if values.dtype == object:
+            object_columns.append(name)
+            arrays["mask_{}".format(j)] = pd.isnull(values)
+            values = values.astype(str)
+        arrays["column_{}".format(j)] = values
+    meta = {
+        "names": list(columns.keys()),
+        "object_columns": object_columns,
+        "info": info,
+    }
+    tmp_fn = filename + ".tmp"
+    with open(tmp_fn, "wb") as f:
+        np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(tmp_fn, filename)
+
+
+def load_columns(filename):
+    """
+    Load a dict of 1D arrays saved by save_columns.
+    """
+    with np.load(filename) as data:
+        meta = json.loads(str(data["meta"]))
+        columns = collections.OrderedDict()
+        for j, name in enumerate(meta["names"]):
+            values = data["column_{}".format(j)]
+            if name in meta["object_columns"]:
+                values = values.astype(object)
+                if "mask_{}".format(j) in data.files:
+                    values[data["mask_{}".format(j)]] = np.nan
+            columns[name] = values
+    return columns
+
+
+def load_column_info(filename):
+    """
+    Return the info saved with a file written by save_columns, or None.
+    """
+    with np.load(filename) as data:
+        return json.loads(str(data["meta"])).get("info")
+
+
+class ArtifactCache:
+    """
+    Cache of intermediate results stored as columnar .npz files in a directory. Each
+    entry is keyed by a sha1 of its name, the signatures of its input files and the
+    parameters used to compute it, so changing any input or parameter invalidates
+    it. Superseded entries with the same name are removed when a new one is written.
+    If an input file is missing, the most recently written entry with the name,
+    inputs and parameters is used, so a cache can outlive large inputs which have
+    since been removed.
+    """
+
+    def __init__(self, directory=os.path.join("all-data", "cache")):
+        self.directory = directory
+
+    def info(self, name, inputs=(), params=None):
+        """
+        Return the description of an entry stored with it, against which entries
+        are matched when an input is missing.
+        """
+        return json.loads(
+            json.dumps(
+                {
+                    "name": name,
+                    "inputs": [os.path.abspath(filename) for filename in inputs],
+                    "params": params,
+                },
+                sort_keys=True,
+                default=str,
+            )
+        )
+
+    def key(self, name, inputs=(), params=None):
+        signature = [name, [file_signature(filename) for filename in inputs], params]
+        return hashlib.sha1(
+            json.dumps(signature, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def path(self, name, key):
+        return os.path.join(self.directory, "{}.{}.npz".format(name, key[:16]))
+
+    def entries(self, name):
+        """
+        Return the paths of the entries stored under name.
+        """
+        if not os.path.exists(self.directory):
+            return []
+        prefix = name + "."
+        return [
+            os.path.join(self.directory, entry)
+            for entry in os.listdir(self.directory)
+            if entry.startswith(prefix)
+            and entry.endswith(".npz")
+            and entry[len(prefix) : -len(".npz")].count(".") == 0
+        ]
+
+    def get_columns(self, name, compute, inputs=(), params=None):
+        """
+        Return the dict of arrays cached under name for these inputs and params,
+        calling compute() to create and store it if there is no current entry.
+        """
+        filename = self.path(name, self.key(name, inputs, params))
+        if os.path.exists(filename):
+            return load_columns(filename)
+        info = self.info(name, inputs, params)
+        missing = [input_fn for input_fn in inputs if not os.path.exists(input_fn)]
+        entries = self.entries(name)
+        if len(missing) > 0:
+            matching = [entry for entry in entries if load_column_info(entry) == info]
+            if len(matching) == 0:
+                raise FileNotFoundError(
+                    "{} missing and no cached {} with the same inputs and "
+                    "parameters".format(", ".join(missing), name)
+                )
+            newest = max(matching, key=os.path.getmtime)
+            print(
+                "Using cached {} as {} is missing".format(newest, ", ".join(missing))
+            )
+            return load_columns(newest)
+        columns = compute()
+        os.makedirs(self.directory, exist_ok=True)
+        for stale in entries:
+            os.remove(stale)
+        save_columns(filename, columns, info=info)
+        return columns
+
+    def get_dataframe(self, name, compute, inputs=(), params=None):
+        """
+        As get_columns, for a compute() returning a DataFrame. The index is not kept.
+        """
+
+        def compute_columns():
+            df = compute()
+            return collections.OrderedDict(
+                (column, df[column].to_numpy()) for column in df.columns
+            )
+
+        return pd.DataFrame(self.get_columns(name, compute_columns, inputs, params))
+
+    def clear(self):
+        if os.path.exists(self.directory):
+            for filename in os.listdir(self.directory):
+                if filename.endswith(".npz"):
+                    os.remove(os.path.join(self.directory, filename))
+
+
+artifact_cache = ArtifactCache()
+
+
+genetic_map_cache_dir = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "all-data", "genetic_maps"
+)
+
+
+class GeneticMap:
+    """
+    A recombination map stored as its physical positions and the cumulative genetic
+    distance (in Morgans) at each of them, so physical positions are converted with a
+    single np.interp. get_positions and get_rates give the same values as the
+    msprime.RecombinationMap it was made from, so it can be used in place of one.
+    """
+
+    def __init__(self, positions, genetic_positions):
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.genetic_positions = np.asarray(genetic_positions, dtype=np.float64)
+
+    @classmethod
+    def from_recombination_map(cls, recombination_map):
+        positions = np.array(recombination_map.get_positions(), dtype=np.float64)
+        rates = np.array(recombination_map.get_rates(), dtype=np.float64)
+        genetic_positions = np.insert(np.cumsum(np.diff(positions) * rates[:-1]), 0, 0)
+        return cls(positions, genetic_positions)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data["positions"], data["genetic_positions"])
+
+    def save(self, filename):
+        tmp_fn = filename + ".tmp"
+        with open(tmp_fn, "wb") as f:
+            np.savez(
+                f, positions=self.positions, genetic_positions=self.genetic_positions
+            )
+        os.replace(tmp_fn, filename)
+
+    def get_positions(self):
+        return self.positions
+
+    def get_rates(self):
+        rates = np.zeros(len(self.positions))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rates[:-1] = np.diff(self.genetic_positions) / np.diff(self.positions)
+        return np.nan_to_num(rates)
+
+    def physical_to_genetic(self, physical_positions):
+        return np.interp(physical_positions, self.positions, self.genetic_positions)
+
+
+def physical_to_genetic(recombination_map, physical_positions):
+    """
+    Return the genetic positions (in Morgans) of physical_positions on a GeneticMap or
+    an msprime.RecombinationMap.
+    """
+    if not isinstance(recombination_map, GeneticMap):
+        recombination_map = GeneticMap.from_recombination_map(recombination_map)
+    return recombination_map.physical_to_genetic(physical_positions)
+
+
+def load_genetic_map(chrom=None, hapmap_fn=None, cache_dir=None):
+    """
+    Return a GeneticMap read from the HapMap format file hapmap_fn or, if that is
+    None, for chromosome chrom (e.g. "chr20") from the stdpopsim HapMapII_GRCh37 map.
+    Maps are converted once and cached as .npz files in cache_dir (by default
+    all-data/genetic_maps), keyed by the path, size and mtime of a HapMap file, so
+    later calls neither parse text nor need the network.
+    """
+    if cache_dir is None:
+        cache_dir = genetic_map_cache_dir
+    if hapmap_fn is not None:
+        key = hashlib.sha1(json.dumps(file_signature(hapmap_fn)).encode()).hexdigest()
+        name = "{}.{}.npz".format(os.path.basename(hapmap_fn), key[:16])
+    elif chrom is not None:
+        name = "HapMapII_GRCh37.{}.npz".format(chrom)
+    else:
+        raise ValueError("Must give either a chromosome or a HapMap file")
+    cache_fn = os.path.join(cache_dir, name)
+    if os.path.exists(cache_fn):
+        return GeneticMap.load(cache_fn)
+    # Only needed when the map is not cached yet
+    import msprime
+    import stdpopsim
 
+    if hapmap_fn is not None:
+        recombination_map = msprime.RecombinationMap.read_hapmap(hapmap_fn)
+    else:
+        genetic_map = stdpopsim.get_species("HomSap").get_genetic_map(
+            id="HapMapII_GRCh37"
+        )
+        if not genetic_map.is_cached():
+            genetic_map.download()
+        recombination_map = genetic_map.get_chromosome_map(chrom)
+    genetic_map = GeneticMap.from_recombination_map(recombination_map)
+    os.makedirs(cache_dir, exist_ok=True)
+    genetic_map.save(cache_fn)
+    return genetic_map
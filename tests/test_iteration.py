@@ -0,0 +1,73 @@
+"""
+Tests for the step bookkeeping in src/iteration.py.
+"""
+import os
+import pickle
+import sys
+import tempfile
+import unittest
+
+import msprime
+import numpy as np
+import tsinfer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import iteration  # NOQA
+
+
+class TestResume(unittest.TestCase):
+    def test_step_five_resumes_after_step_three_is_reloaded(self):
+        ts = msprime.simulate(8, mutation_rate=2, random_seed=1)
+        positions = ts.tables.sites.position
+        # As returned by get_dated_sampledata: Python float keys and values
+        constr_mut_pos = {float(pos): float(j + 1) for j, pos in enumerate(positions)}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output_fn = os.path.join(tmpdir, "run")
+            samples_fn = output_fn + ".constrained.samples"
+            constrained_fn = output_fn + ".constrained.npz"
+            samples = tsinfer.SampleData.from_tree_sequence(
+                ts, path=samples_fn, use_sites_time=False
+            )
+            np.savez(
+                constrained_fn,
+                constr_pos=np.array(list(constr_mut_pos.keys()), dtype=np.float64),
+                constr_ages=np.array(list(constr_mut_pos.values()), dtype=np.float64),
+                constrained_ages=ts.tables.nodes.time,
+            )
+
+            def compute():
+                with open(output_fn + ".tsdatesecondpass.dates.p", "wb") as f:
+                    pickle.dump(ts.tables.nodes.time, f)
+                ts.dump(output_fn + ".tsdatesecondpass.trees")
+                return "computed"
+
+            def fail():
+                raise AssertionError("Step 5 was recomputed")
+
+            result = iteration.run_step(
+                "tsdatesecondpass",
+                compute,
+                lambda *paths: "loaded",
+                [ts, samples, constr_mut_pos],
+                {"Ne": 10000},
+                output_fn=output_fn,
+                resume=True,
+            )
+            self.assertEqual(result, "computed")
+            samples.close()
+
+            # Resume step 3 from disk, as iter_infer does
+            loaded_samples, loaded_mut_pos, _ = iteration.load_dated_sampledata(
+                samples_fn, constrained_fn
+            )
+            self.assertEqual(loaded_mut_pos, constr_mut_pos)
+            result = iteration.run_step(
+                "tsdatesecondpass",
+                fail,
+                lambda *paths: "loaded",
+                [ts, loaded_samples, loaded_mut_pos],
+                {"Ne": 10000},
+                output_fn=output_fn,
+                resume=True,
+            )
+            self.assertEqual(result, "loaded")
@@ -0,0 +1,98 @@
+"""
+Tests for the pairwise TMRCA script in src/tmrcas.py.
+"""
+import itertools
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import msprime
+import numpy as np
+import pandas as pd
+import tskit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import tmrcas  # NOQA
+
+
+def get_dated_two_population_ts(seed=1):
+    """
+    Return a simulated two population tree sequence with named populations and
+    tsdate-style "mn" node metadata, set to twice the node time.
+    """
+    ts = msprime.simulate(
+        population_configurations=[
+            msprime.PopulationConfiguration(sample_size=6),
+            msprime.PopulationConfiguration(sample_size=4),
+        ],
+        migration_matrix=[[0, 1], [1, 0]],
+        length=1000,
+        recombination_rate=1e-3,
+        random_seed=seed,
+    )
+    tables = ts.dump_tables()
+    tables.populations.metadata_schema = tskit.MetadataSchema(None)
+    tables.populations.packset_metadata(
+        [json.dumps({"name": name}).encode() for name in ["A", "B"]]
+    )
+    nodes = tables.nodes
+    nodes.metadata_schema = tskit.MetadataSchema(None)
+    nodes.packset_metadata(
+        [
+            b"" if flags & tskit.NODE_IS_SAMPLE else json.dumps({"mn": 2 * time}).encode()
+            for flags, time in zip(nodes.flags, nodes.time)
+        ]
+    )
+    return tables.tree_sequence()
+
+
+def naive_tmrcas(ts, sample_sets, node_times):
+    """
+    Span weighted geometric mean TMRCA over distinct pairs, one MRCA query per pair.
+    """
+    num_sets = len(sample_sets)
+    sums = np.zeros((num_sets, num_sets))
+    for tree in ts.trees():
+        for i, j in itertools.product(range(num_sets), repeat=2):
+            for u in sample_sets[i]:
+                for v in sample_sets[j]:
+                    if u != v:
+                        sums[i, j] += tree.span * np.log(node_times[tree.mrca(u, v)])
+    sizes = np.array([len(nodes) for nodes in sample_sets])
+    num_pairs = np.outer(sizes, sizes) - np.diag(sizes)
+    return np.exp(sums / (ts.sequence_length * num_pairs))
+
+
+class TestMain(unittest.TestCase):
+    def test_simulated_ts(self):
+        ts = get_dated_two_population_ts()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            ts_fn = os.path.join(tmpdir, "dated.trees")
+            output_fn = os.path.join(tmpdir, "dated.tmrcas")
+            ts.dump(ts_fn)
+            argv = [
+                "tmrcas.py",
+                "--input",
+                ts_fn,
+                "--output",
+                output_fn,
+                "--num-workers",
+                "2",
+                "--num-windows",
+                "3",
+                "--seed",
+                "1",
+            ]
+            with mock.patch.object(sys, "argv", argv):
+                tmrcas.main()
+            df = pd.read_csv(output_fn, index_col=0)
+        self.assertEqual(list(df.columns), ["A", "B"])
+        self.assertEqual(list(df.index), ["A", "B"])
+        sample_sets = tmrcas.sample_population_nodes(ts, num_nodes=20, seed=1)
+        node_times = 2 * ts.tables.nodes.time
+        np.testing.assert_allclose(
+            df.values, naive_tmrcas(ts, sample_sets, node_times)
+        )
@@ -0,0 +1,100 @@
+"""
+Tests for the helpers in src/utility.py.
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import msprime
+import numpy as np
+import tskit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import utility  # NOQA
+
+
+def get_dated_ts(seed=1):
+    """
+    Return a simulated tree sequence whose non-sample nodes carry tsdate-style
+    metadata, with the unconstrained mean "mn" set to twice the node time.
+    """
+    ts = msprime.simulate(10, mutation_rate=1, random_seed=seed)
+    tables = ts.dump_tables()
+    nodes = tables.nodes
+    metadata = [
+        b"" if flags & tskit.NODE_IS_SAMPLE else json.dumps({"mn": 2 * time}).encode()
+        for flags, time in zip(nodes.flags, nodes.time)
+    ]
+    nodes.packset_metadata(metadata)
+    return tables.tree_sequence()
+
+
+class TestDecodeMetadataField(unittest.TestCase):
+    def test_table_columns(self):
+        ts = get_dated_ts()
+        nodes = ts.tables.nodes
+        non_samples = (nodes.flags & tskit.NODE_IS_SAMPLE) == 0
+        values = utility.decode_metadata_field(
+            nodes.metadata, nodes.metadata_offset, "mn", non_samples
+        )
+        np.testing.assert_allclose(values, 2 * nodes.time[non_samples])
+
+    def test_uint32_offsets(self):
+        ts = get_dated_ts()
+        nodes = ts.tables.nodes
+        non_samples = (nodes.flags & tskit.NODE_IS_SAMPLE) == 0
+        values = utility.decode_metadata_field(
+            nodes.metadata,
+            nodes.metadata_offset.astype(np.uint32),
+            "mn",
+            non_samples,
+        )
+        np.testing.assert_allclose(values, 2 * nodes.time[non_samples])
+
+    def test_missing_metadata(self):
+        ts = get_dated_ts()
+        nodes = ts.tables.nodes
+        with self.assertRaises(ValueError):
+            utility.decode_metadata_field(
+                nodes.metadata,
+                nodes.metadata_offset,
+                "mn",
+                np.ones(ts.num_nodes, dtype=bool),
+            )
+
+
+class TestGetUnconstrainedNodeTimes(unittest.TestCase):
+    def test_dated_ts(self):
+        ts = get_dated_ts()
+        times = utility.get_unconstrained_node_times(ts)
+        samples = ts.samples()
+        non_samples = np.setdiff1d(np.arange(ts.num_nodes), samples)
+        np.testing.assert_array_equal(times[samples], ts.tables.nodes.time[samples])
+        np.testing.assert_allclose(
+            times[non_samples], 2 * ts.tables.nodes.time[non_samples]
+        )
+
+
+class TestArtifactCache(unittest.TestCase):
+    def test_missing_input(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = utility.ArtifactCache(os.path.join(tmpdir, "cache"))
+            input_fn = os.path.join(tmpdir, "input.txt")
+            with open(input_fn, "w") as f:
+                f.write("1\n")
+
+            def compute():
+                return {"x": np.arange(3), "label": np.array(["a", None, "c"])}
+
+            cache.get_columns("table", compute, inputs=[input_fn], params={"a": 1})
+            os.remove(input_fn)
+            columns = cache.get_columns(
+                "table", None, inputs=[input_fn], params={"a": 1}
+            )
+            np.testing.assert_array_equal(columns["x"], np.arange(3))
+            self.assertEqual(columns["label"][0], "a")
+            self.assertTrue(np.isnan(columns["label"][1]))
+            with self.assertRaises(FileNotFoundError):
+                cache.get_columns("table", None, inputs=[input_fn], params={"a": 2})